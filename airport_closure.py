@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+
+"""What happens to the network if an airport closes?
+
+Instead of editing the flight file and rerunning the whole pipeline,
+we keep an inverted index from every airport to the flights whose
+flight_path goes through it.  Closing airports then only touches the
+flights listed under them:
+
+  - a flight whose origin closes is cancelled,
+  - otherwise the closed airports are dropped from its path and the
+    remaining stops are re-sequenced (with the same stop order memo as
+    sort_flights_by_distance.py), re-costed and re-pruned; a flight
+    left with a single airport is cancelled too,
+  - the passengers of a flight whose origin or destination closes
+    can't be carried at all: they are stranded, and a flight that
+    still flies without its destination goes on with none of them and
+    the end of its new path as its destination,
+  - the passengers of the other flights that are lost (cancelled, or
+    no longer profitable) are sent to the closest profitable flight, with
+    the metric of calc_cumulative_distance_metric() and the seat cap
+    of accommodate_passengers().  That metric adds up, over the cities
+    of the lost flight, the distance to the nearest city of the
+    candidate, so we keep a matrix of the distance from every airport
+    to the nearest city of every flight; the metrics of all the lost
+    flights against all the candidates are then one matrix product.
+
+Every other flight keeps its path, profit and profitability from the
+baseline, which is computed once.
+
+For connectivity we keep the number of profitable flights flying each
+(undirected) leg.  A closure only changes the counts of the legs of
+the affected flights, and the airports still connected are found by
+union-find over the legs left.
+
+So the re-sequencing, re-costing and connectivity of a scenario cost
+time in the number of affected flights and legs.  Each scenario still
+costs time linear in the size of the flight file, though: it copies
+the per-flight profits and profitability, and the replacement search
+multiplies the lost flights' cities against the nearest-city matrix
+of all the profitable flights (airports x flights).  That is a few
+vectorized passes -- about 0.1 s per scenario for 18000 flights --
+rather than a rerun of the pipeline.
+"""
+
+import argparse
+from collections import Counter, defaultdict
+import numpy as np
+
+from flight_utils import *
+from flight_optimization import prune_unprofitable_flights, calc_cost, calc_income
+
+
+class AirportIndex:
+    """Inverted index from airport code to the positions (in the flight
+    list) of the flights whose path includes it."""
+
+    def __init__(self, flights):
+        self.flights_at = defaultdict(list)
+        for position, record in enumerate(flights):
+            for code in dict.fromkeys(flight_path2city_list(record['flight_path'])):
+                self.flights_at[code].append(position)
+
+    def flights_through(self, codes):
+        """Sorted positions of the flights that go through any of the
+        airports."""
+        positions = set()
+        for code in codes:
+            positions.update(self.flights_at.get(code, ()))
+        return sorted(positions)
+
+
+class DisjointSets:
+    """Union-find with path halving and union by size."""
+
+    def __init__(self, items):
+        self.parent = {item: item for item in items}
+        self.size = {item: 1 for item in items}
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    def component_sizes(self):
+        return [self.size[item] for item in self.parent if self.parent[item] == item]
+
+
+def legs_of(city_list):
+    """The undirected legs of a path, as sorted pairs."""
+    return [tuple(sorted(pair)) for pair in zip(city_list[:-1], city_list[1:])
+            if pair[0] != pair[1]]
+
+
+def connected_pairs(airport_codes, leg_counts):
+    """Union-find over the legs that are still flown; returns the number
+    of connected (unordered) airport pairs and the component sizes."""
+    components = DisjointSets(airport_codes)
+    for (c1, c2), count in leg_counts.items():
+        if count > 0:
+            components.union(c1, c2)
+    sizes = components.component_sizes()
+    return sum(s * (s - 1) // 2 for s in sizes), sizes
+
+
+def flight_profit(record):
+    return calc_income(record) - calc_cost(record)
+
+
+class ClosureModel:
+    """The baseline network (sorted flights, pruned once) and what-if
+    closures of it."""
+
+    def __init__(self, flights, memo=None, airport_table=airports):
+        self.flights = list(flights)
+        self.memo = memo if memo is not None else StopOrderMemo()
+        self.index = AirportIndex(self.flights)
+        self.airport_codes = list(airport_table.keys())
+        self.code2index = {code: i for i, code in enumerate(self.airport_codes)}
+        self.distance_matrix = haversine_distance_matrix_nm(
+            [airport_table[c]['lat'] for c in self.airport_codes],
+            [airport_table[c]['lon'] for c in self.airport_codes])
+        self.profit = np.array([flight_profit(record) for record in self.flights])
+        profitable, _ = prune_unprofitable_flights(self.flights)
+        profitable_numbers = {record['flight_number'] for record in profitable}
+        self.profitable = np.array([record['flight_number'] in profitable_numbers
+                                    for record in self.flights], dtype=bool)
+        # nearest[a, f]: distance from airport a to the nearest city of
+        # flight f, for the replacement search
+        city_lists = [flight_path2city_list(record['flight_path']) for record in self.flights]
+        self.nearest = np.empty((len(self.airport_codes), len(city_lists)))
+        for row, city_list in enumerate(city_lists):
+            self.nearest[:, row] = self.nearest_city_distance(city_list)
+        # how many profitable flights fly each leg
+        self.leg_counts = Counter()
+        for row in np.flatnonzero(self.profitable):
+            self.leg_counts.update(legs_of(city_lists[row]))
+        self.served = {code for leg, count in self.leg_counts.items() if count > 0 for code in leg}
+        self.connected_pairs, _ = connected_pairs(self.served, self.leg_counts)
+
+    def reroute(self, record, closed):
+        """The record without the closed airports, re-sequenced, or None
+        if the flight is cancelled.  If its destination closed, it ends
+        where the new path ends and carries none of its passengers."""
+        city_list = flight_path2city_list(record['flight_path'])
+        if city_list[0] in closed or record['origin'] in closed:
+            return None
+        remaining = [c for c in city_list if c not in closed]
+        if len(set(remaining)) < 2:
+            return None
+        new_city_list, _ = self.memo.shortest_path(remaining)
+        new_record = dict(record)
+        new_record['flight_path'] = ', '.join(new_city_list)
+        new_record['n_stops'] = len(new_city_list) - 2
+        if record['destination'] in closed:
+            new_record['destination'] = new_city_list[-1]
+            new_record['passengers'] = 0
+        return new_record
+
+    def nearest_city_distance(self, city_list):
+        """Distance from every airport to the nearest city of the list."""
+        return self.distance_matrix[:, [self.code2index[c] for c in city_list]].min(axis=1)
+
+    def what_if(self, closed):
+        """Closes the given airports.  Returns a dictionary with the
+        rerouted, cancelled and newly eliminated flights, the
+        replacements found for the lost ones, the profit before and
+        after, and the loss of connectivity.  Takes time linear in the
+        number of flights (see the module docstring)."""
+        closed = set(closed)
+        for code in closed:
+            if code not in self.code2index:
+                raise KeyError(f'unknown airport {code}')
+        affected = self.index.flights_through(closed)
+        rerouted, cancelled, newly_eliminated = [], [], []
+        profitable = self.profitable.copy()
+        profit = self.profit.copy()
+        nearest = {}
+        leg_counts = self.leg_counts.copy()
+        lost = []
+        stranded_passengers = 0
+        for row in affected:
+            record = self.flights[row]
+            old_city_list = flight_path2city_list(record['flight_path'])
+            if self.profitable[row]:
+                leg_counts.subtract(legs_of(old_city_list))
+            # no other flight takes these passengers where they're going
+            endpoint_closed = record['origin'] in closed or record['destination'] in closed
+            if endpoint_closed and self.profitable[row]:
+                stranded_passengers += int(record['passengers'])
+            new_record = self.reroute(record, closed)
+            if new_record is None:
+                cancelled.append(record)
+                if self.profitable[row] and not endpoint_closed:
+                    lost.append(record)
+                profitable[row] = False
+                continue
+            rerouted.append(new_record)
+            new_city_list = flight_path2city_list(new_record['flight_path'])
+            nearest[row] = self.nearest_city_distance(new_city_list)
+            profit[row] = flight_profit(new_record)
+            still_profitable, _ = prune_unprofitable_flights([new_record])
+            profitable[row] = bool(still_profitable)
+            if profitable[row]:
+                leg_counts.update(legs_of(new_city_list))
+            elif self.profitable[row]:
+                newly_eliminated.append(new_record)
+                if not endpoint_closed:
+                    lost.append(new_record)
+
+        # send the passengers of the lost flights to the closest
+        # profitable flight, as accommodate_passengers() does
+        candidate_rows = np.flatnonzero(profitable)
+        replacements = {}
+        updated_passengers = {}
+        if lost and len(candidate_rows) > 0:
+            candidate_nearest = self.nearest[:, candidate_rows]
+            for row, distances in nearest.items():
+                if profitable[row]:
+                    candidate_nearest[:, np.searchsorted(candidate_rows, row)] = distances
+            # how many times each airport is a city of each lost flight
+            city_counts = np.zeros((len(lost), len(self.airport_codes)))
+            for i, record in enumerate(lost):
+                for c in flight_path2city_list(record['flight_path']):
+                    if c not in closed:
+                        city_counts[i, self.code2index[c]] += 1
+            best_columns = np.argmin(city_counts @ candidate_nearest, axis=1)
+            for record, counts, column in zip(lost, city_counts, best_columns):
+                if not counts.any():
+                    continue
+                best = candidate_rows[column]
+                replacements[record['flight_number']] = self.flights[best]['flight_number']
+                updated_passengers[best] = min(int(record['passengers'])
+                                               + int(self.flights[best]['passengers']),
+                                               seat_capacity)
+        for row, passengers in updated_passengers.items():
+            profit[row] += (record_fare(self.flights[row])
+                            * (passengers - int(self.flights[row]['passengers'])))
+
+        served = {code for leg, count in leg_counts.items() if count > 0 for code in leg}
+        pairs_after, sizes = connected_pairs(served, leg_counts)
+        return {'closed': sorted(closed),
+                'affected': len(affected),
+                'rerouted': rerouted,
+                'cancelled': cancelled,
+                'newly_eliminated': newly_eliminated,
+                'replacements': replacements,
+                'stranded_passengers': stranded_passengers
+                                       + sum(int(r['passengers']) for r in lost
+                                             if r['flight_number'] not in replacements),
+                'profit_before': float(self.profit[self.profitable].sum()),
+                'profit_after': float(profit[profitable].sum()),
+                'airports_served': len(served),
+                'airports_unserved': sorted(self.served - served - closed),
+                'components': len(sizes),
+                'connected_pairs_before': self.connected_pairs,
+                'connected_pairs_after': pairs_after,
+                'connectivity_loss': (1 - pairs_after / self.connected_pairs
+                                      if self.connected_pairs else 0.0)}
+
+
+def closure_report(result):
+    print(f"# closing {', '.join(result['closed'])}: {result['affected']} flights affected,"
+          f" {len(result['rerouted'])} rerouted, {len(result['cancelled'])} cancelled,"
+          f" {len(result['newly_eliminated'])} no longer profitable")
+    print(f"# {len(result['replacements'])} lost flights replaced,"
+          f" {result['stranded_passengers']} passengers stranded")
+    print(f"# profit: ${result['profit_before']:.2f} -> ${result['profit_after']:.2f}"
+          f" ({result['profit_after'] - result['profit_before']:+.2f})")
+    print(f"# {result['airports_served']} airports served in {result['components']} components,"
+          f" connected pairs {result['connected_pairs_before']} -> {result['connected_pairs_after']}"
+          f" ({100 * result['connectivity_loss']:.1f}% lost)")
+    if result['airports_unserved']:
+        print(f"# no longer served: {', '.join(result['airports_unserved'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='What-if analysis of closing one or more airports.')
+    parser.add_argument('closed', nargs='*', help='airport codes to close together, e.g. DEN')
+    parser.add_argument('--flights', default='sorted_flights_new.txt',
+                        help='newstyle flight file (before pruning)')
+    parser.add_argument('--each', action='store_true',
+                        help='close every airport on its own and rank them by connectivity loss')
+    args = parser.parse_args()
+    if not args.closed and not args.each:
+        parser.error('give airport codes to close, or --each')
+    unknown = [code for code in args.closed if code not in airports]
+    if unknown:
+        parser.error(f"unknown airport codes: {', '.join(unknown)}")
+
+    model = ClosureModel(iter_flights_newstyle(args.flights))
+    if args.closed:
+        result = model.what_if(args.closed)
+        for record in result['rerouted']:
+            print(f"REROUTED: Flight {record['flight_number']}: {record['flight_path']}")
+        for record in result['cancelled']:
+            print(f"CANCELLED: Flight {record['flight_number']}: {record['flight_path']}")
+        for dead, replacement in result['replacements'].items():
+            print(f"REPLACEMENT: Flight {dead} -> Flight {replacement}")
+        closure_report(result)
+    if args.each:
+        results = [model.what_if([code]) for code in model.airport_codes]
+        results.sort(key=lambda r: (-r['connectivity_loss'], r['profit_after'] - r['profit_before']))
+        for result in results:
+            print(f"CLOSURE: {result['closed'][0]}: {100 * result['connectivity_loss']:5.1f}% of"
+                  f" connected pairs lost, profit {result['profit_after'] - result['profit_before']:+.2f},"
+                  f" {result['stranded_passengers']} passengers stranded")
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,7 @@ from flight_utils import *
 class FlightSimulation: 
     def read_flights(self, filename): # Reads generated_flights_new.txt
         flight_data = []
-        with open(filename, 'r') as file:
+        with open_flight_file(filename, 'r') as file:
             lines = file.readlines()
 
         for line in lines:
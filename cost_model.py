@@ -0,0 +1,138 @@
+#! /usr/bin/env python3
+
+"""Cost and income of whole flight tables at once.
+
+A CostModel holds the figures that go into calc_cost() and
+calc_income() -- aircraft speed and hourly cost, layover time and
+cost, ticket price and seats -- plus optional fees charged at each
+airport the flight touches.  A FlightTable holds a flight file as
+NumPy arrays (distance, stops, passengers, and the list of airport
+visits), so that the cost, income and profit of every flight come out
+of a few array operations.  Re-pricing the network, or flying it with
+a different aircraft type, is then one call instead of a rerun of the
+pipeline.
+"""
+
+import sys
+import numpy as np
+
+from flight_utils import *
+
+
+class FlightTable:
+    """Newstyle flight records turned into arrays.  Legs and airport
+    visits are stored as flat arrays with the index of the flight they
+    belong to, so per-flight sums are a np.bincount() away."""
+
+    def __init__(self, records, airport_table=airports):
+        # records can be any iterable (such as iter_flights_newstyle()),
+        # we only go through it once
+        self.flight_numbers = []
+        self.airport_codes = list(airport_table.keys())
+        code2index = {code: i for i, code in enumerate(self.airport_codes)}
+        passengers = []
+        fares = []
+        visit_flight = []
+        visit_airport = []
+        for flight_index, record in enumerate(records):
+            self.flight_numbers.append(record['flight_number'])
+            passengers.append(int(record['passengers']))
+            fares.append(float(record['fare']) if 'fare' in record else np.nan)
+            city_list = flight_path2city_list(record['flight_path'])
+            visit_flight.extend([flight_index] * len(city_list))
+            visit_airport.extend(code2index[city] for city in city_list)
+        self.n_flights = len(self.flight_numbers)
+        self.visit_flight = np.array(visit_flight, dtype=np.int64)
+        self.visit_airport = np.array(visit_airport, dtype=np.int64)
+        self.passengers = np.array(passengers, dtype=np.int64)
+        # NaN for the flights without a fare of their own
+        self.fares = np.array(fares, dtype=float)
+        visits_per_flight = np.bincount(self.visit_flight, minlength=self.n_flights)
+        self.n_stops = np.maximum(visits_per_flight - 2, 0)
+        # a leg joins two consecutive visits of the same flight
+        same_flight = self.visit_flight[1:] == self.visit_flight[:-1]
+        self.leg_flight = self.visit_flight[1:][same_flight]
+        self.leg_from = self.visit_airport[:-1][same_flight]
+        self.leg_to = self.visit_airport[1:][same_flight]
+        lat = np.array([airport_table[code]['lat'] for code in self.airport_codes])
+        lon = np.array([airport_table[code]['lon'] for code in self.airport_codes])
+        self.leg_distance_nm = haversine_distance_array_nm(lat[self.leg_from], lon[self.leg_from],
+                                                           lat[self.leg_to], lon[self.leg_to])
+        self.distance_nm = np.bincount(self.leg_flight, weights=self.leg_distance_nm,
+                                       minlength=self.n_flights)
+
+
+class CostModel:
+    """The cost figures of the airline.  airport_fees maps an airport
+    code to a fee charged every time a flight visits that airport."""
+
+    def __init__(self, aircraft=default_aircraft, ticket_price=avg_ticket_price,
+                 layover_time=layover_time_per_stop,
+                 layover_cost=layover_cost_per_hour, airport_fees=None):
+        self.aircraft = aircraft
+        self.ticket_price = ticket_price
+        self.layover_time = layover_time
+        self.layover_cost = layover_cost
+        self.airport_fees = dict(airport_fees or {})
+
+    def with_aircraft(self, aircraft):
+        """Returns the same model flown with another aircraft type."""
+        return CostModel(aircraft, self.ticket_price, self.layover_time,
+                         self.layover_cost, self.airport_fees)
+
+    def flight_time(self, table):
+        return table.distance_nm / aircraft_types[self.aircraft]['speed_knots']
+
+    def fees(self, table):
+        """Sum of the airport fees of every flight."""
+        if not self.airport_fees:
+            return np.zeros(table.n_flights)
+        fee_per_airport = np.array([self.airport_fees.get(code, 0.0)
+                                    for code in table.airport_codes])
+        return np.bincount(table.visit_flight,
+                           weights=fee_per_airport[table.visit_airport],
+                           minlength=table.n_flights)
+
+    def cost(self, table):
+        """Operating cost plus layover cost plus fees of every flight
+        -- the same as calc_cost() when there are no fees."""
+        operational_cost = aircraft_types[self.aircraft]['cost_per_hour'] * self.flight_time(table)
+        layover_cost = self.layover_time * table.n_stops * self.layover_cost
+        return operational_cost + layover_cost + self.fees(table)
+
+    def fares(self, table):
+        """Ticket price of every flight: its own fare if it has one,
+        otherwise the model's ticket_price."""
+        return np.where(np.isnan(table.fares), self.ticket_price, table.fares)
+
+    def income(self, table):
+        """Ticket income of every flight; passengers beyond the seats of
+        the aircraft can't be carried."""
+        seats = aircraft_types[self.aircraft]['seats']
+        return self.fares(table) * np.minimum(table.passengers, seats)
+
+    def profit(self, table):
+        return self.income(table) - self.cost(table)
+
+
+def main():
+    """Prices a flight file with every aircraft type and prints the
+    totals."""
+    flights_fname = 'sorted_flights_new.txt'
+    if len(sys.argv) > 2:
+        raise Exception(f'*error* too many arguments - usage: {sys.argv[0]} [flight_fname]')
+    elif len(sys.argv) == 2:
+        flights_fname = sys.argv[1]
+    table = FlightTable(load_flights_newstyle(flights_fname))
+    model = CostModel()
+    for aircraft in aircraft_types:
+        model = model.with_aircraft(aircraft)
+        profit = model.profit(table)
+        print(f'{aircraft:>8}: cost ${model.cost(table).sum():14.2f}'
+              f'   income ${model.income(table).sum():14.2f}'
+              f'   profit ${profit.sum():14.2f}'
+              f'   ({np.count_nonzero(profit >= 0)} of {table.n_flights} flights profitable)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+
+"""Gravity model of passenger demand.
+
+The demand between two airports is taken to be proportional to the
+product of their populations, divided by the distance between them
+raised to some power k:
+
+    demand(i, j) = G * pop(i) * pop(j) / distance(i, j)**k
+
+We multiply by some (seeded) log-normal noise, round, and clip the
+result to between min_passengers and the seats on the plane.  G is
+chosen so that the average demand after all that matches the average
+of the old random passenger counts: clipping raises the small demands
+and cuts the big ones, so G is found by a few fixed-point steps that
+rescale it by target / mean.  Each step computes the whole
+origin/destination matrix in one array expression.
+"""
+
+import sys
+import numpy as np
+
+from flight_utils import *
+
+min_passengers = 20
+mean_passengers = 112           # mean of the old random.randint(20, 204)
+scale_steps = 50                # most fixed-point steps on G
+scale_tolerance = 0.1           # passengers off the target mean we accept
+
+
+def gravity_demand(populations, distance_matrix, k=1.0,
+                   noise_sigma=0.25, seed=None):
+    """Takes an array of populations and the matching distance matrix
+    (nautical miles) and returns the integer matrix of passengers for
+    every origin/destination pair.  The diagonal is zero."""
+    populations = np.asarray(populations, dtype=float)
+    distance_matrix = np.asarray(distance_matrix, dtype=float)
+    n = len(populations)
+    off_diagonal = ~np.eye(n, dtype=bool)
+    # avoid dividing by zero on the diagonal (and for co-located
+    # airports); the diagonal gets masked out below anyway
+    safe_distance = np.where(distance_matrix > 0, distance_matrix, np.inf)
+    raw = np.outer(populations, populations) / safe_distance**k
+    mean_raw = raw[off_diagonal].mean() if n > 1 else 0.0
+    scale = mean_passengers / mean_raw if mean_raw > 0 else 0.0
+    rng = np.random.default_rng(seed)
+    noise = rng.lognormal(mean=-noise_sigma**2 / 2, sigma=noise_sigma, size=raw.shape)
+    noisy = raw * noise
+    for _ in range(scale_steps):
+        demand = np.clip(np.rint(scale * noisy), min_passengers, seat_capacity)
+        mean_demand = demand[off_diagonal].mean() if n > 1 else mean_passengers
+        if abs(mean_demand - mean_passengers) <= scale_tolerance or scale == 0:
+            break
+        scale *= mean_passengers / mean_demand
+    return np.where(off_diagonal, demand, 0).astype(int)
+
+
+def gravity_demand_for_airports(airport_codes, airport_table=None,
+                                k=1.0, noise_sigma=0.25, seed=None):
+    """Computes the gravity demand for the given airport codes.
+    Coordinates come from the airports dictionary (falling back on the
+    airport table) and populations from the airport table, which is
+    read from airports.txt if not given.  Returns a dictionary mapping
+    code -> row/column index, and the demand matrix."""
+    if airport_table is None:
+        airport_table = load_airport_table()
+    airport_codes = list(airport_codes)
+    coords = [airports.get(code, airport_table.get(code)) for code in airport_codes]
+    lats = [c['lat'] for c in coords]
+    lons = [c['lon'] for c in coords]
+    populations = [airport_table[code]['population'] for code in airport_codes]
+    distance_matrix = haversine_distance_matrix_nm(lats, lons)
+    demand = gravity_demand(populations, distance_matrix, k=k,
+                            noise_sigma=noise_sigma, seed=seed)
+    code2index = {code: i for i, code in enumerate(airport_codes)}
+    return code2index, demand
+
+
+def main():
+    """Prints the demand matrix for the airports in airports.txt (or
+    for the first N of them, if N is given on the command line)."""
+    airport_table = load_airport_table()
+    codes = list(airport_table.keys())
+    if len(sys.argv) > 2:
+        raise Exception(f'*error* too many arguments - usage: {sys.argv[0]} [n_airports]')
+    elif len(sys.argv) == 2:
+        codes = codes[:int(sys.argv[1])]
+    code2index, demand = gravity_demand_for_airports(codes, airport_table, seed=0)
+    np.set_printoptions(linewidth=200, threshold=sys.maxsize)
+    print('AIRPORTS:', ' '.join(codes))
+    print(demand)
+    off_diagonal = ~np.eye(len(codes), dtype=bool)
+    print(f'# mean passengers: {demand[off_diagonal].mean():.1f}')
+
+
+if __name__ == '__main__':
+    main()
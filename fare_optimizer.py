@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+
+"""Sets the fare of every route to the one that brings in the most
+ticket income.
+
+calc_income() prices every seat at the same average ticket price, so a
+route can be pruned as unprofitable when a different fare would have
+paid for it.  Here the passengers recorded for a route are taken as
+its demand at the average price, and demand at other prices follows a
+constant-elasticity curve:
+
+    demand(p) = passengers * (p / avg_ticket_price) ** -elasticity
+
+with no more than the seats of the aircraft actually flown.  The cost
+of a flight doesn't depend on its passengers, so the fare that
+maximizes income also maximizes profit.
+
+Every route is evaluated at every point of a price grid at once, as a
+routes x prices array (in chunks of routes, so that no more than
+max_elements are held at a time), and the best point is taken per
+route.  With an elasticity above 1 lowering the fare sells more than
+it loses, until the flight is full; below 1 the highest fare on the
+grid wins -- so the grid bounds matter.
+
+The records are written back with their fare and the passengers
+expected at it; calc_income(), and so prune_unprofitable_flights(),
+then use them.  A record that already has a fare has its passengers
+taken back to the average fare along the same curve before it is
+priced again.
+"""
+
+import argparse
+import numpy as np
+
+from flight_utils import *
+from cost_model import FlightTable
+
+default_elasticity = 1.2
+price_grid_points = 201
+min_price_factor = 0.5          # grid from half...
+max_price_factor = 2.5          # ...to two and a half times the average fare
+max_elements = 4000000          # routes x prices held in memory at once
+
+
+def price_grid(n_points=price_grid_points, low=min_price_factor, high=max_price_factor):
+    return avg_ticket_price * np.linspace(low, high, n_points)
+
+
+def optimize_fares(base_passengers, elasticity=default_elasticity, prices=None,
+                   seats=seat_capacity):
+    """For arrays of passengers at the average fare (and elasticities,
+    one per route or one for all), returns the income-maximizing fare,
+    the passengers at that fare and the income."""
+    if prices is None:
+        prices = price_grid()
+    base_passengers = np.asarray(base_passengers, dtype=float)
+    elasticity = np.broadcast_to(np.asarray(elasticity, dtype=float), base_passengers.shape)
+    n_routes = len(base_passengers)
+    fares = np.empty(n_routes)
+    passengers = np.empty(n_routes, dtype=np.int64)
+    incomes = np.empty(n_routes)
+    relative_prices = prices / avg_ticket_price
+    rows_per_chunk = max(1, max_elements // len(prices))
+    for start in range(0, n_routes, rows_per_chunk):
+        rows = slice(start, min(start + rows_per_chunk, n_routes))
+        # routes x prices
+        demand = base_passengers[rows, None] * relative_prices[None, :] ** -elasticity[rows, None]
+        sold = np.minimum(np.floor(demand), seats)
+        income = prices[None, :] * sold
+        best = np.argmax(income, axis=1)
+        chunk_rows = np.arange(len(best))
+        fares[rows] = prices[best]
+        passengers[rows] = sold[chunk_rows, best]
+        incomes[rows] = income[chunk_rows, best]
+    return fares, passengers, incomes
+
+
+def price_records(records, elasticity=default_elasticity, prices=None):
+    """Returns copies of the records with their fare and the passengers
+    expected at that fare."""
+    table = FlightTable(records)
+    base_passengers = np.where(np.isnan(table.fares), table.passengers,
+                               table.passengers * (table.fares / avg_ticket_price) ** elasticity)
+    fares, passengers, _ = optimize_fares(base_passengers, elasticity, prices)
+    priced = []
+    for record, fare, n_passengers in zip(records, fares, passengers):
+        new_record = dict(record)
+        new_record['passengers'] = int(n_passengers)
+        new_record['fare'] = f'{fare:.2f}'
+        priced.append(new_record)
+    return priced
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Set the income-maximizing fare of every route.')
+    parser.add_argument('flights_fname', nargs='?', default='sorted_flights_new.txt',
+                        help='newstyle flight file to price')
+    parser.add_argument('--out', default='priced_flights_new.txt',
+                        help='file in which to write the priced flights')
+    parser.add_argument('--elasticity', type=float, default=default_elasticity,
+                        help='price elasticity of demand (as a positive number)')
+    parser.add_argument('--grid', type=int, default=price_grid_points,
+                        help='number of prices tried per route')
+    args = parser.parse_args()
+
+    records = load_flights_newstyle(args.flights_fname)
+    base_income = sum(record_fare(r) * min(int(r['passengers']), seat_capacity) for r in records)
+    priced = price_records(records, args.elasticity, price_grid(args.grid))
+    for record, new_record in zip(records, priced):
+        print(f"FARE: Flight {record['flight_number']}: ${new_record['fare']},"
+              f" {record['passengers']} -> {new_record['passengers']} passengers")
+    income = sum(float(r['fare']) * r['passengers'] for r in priced)
+    print(f'# ticket income at the old fares: ${base_income:.2f}, at the optimized fares: ${income:.2f}')
+    write_flights_newstyle(args.out, priced)
+
+
+if __name__ == '__main__':
+    main()
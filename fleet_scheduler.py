@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+
+"""Turns a network of flights into a one-day schedule and works out
+how many aircraft are needed to fly it.
+
+Every flight gets a departure time (either the departure_time entry in
+its record, in hours, or a random one inside the operating day).  The
+block time of a flight is the flight time of each leg (at 485 knots,
+from calculate_flight_time()) plus 1.5 hours of layover at every
+intermediate stop; after landing the aircraft needs a turnaround
+before it can fly again.
+
+The rotations are built with a sweep over the departures in time
+order.  Aircraft that have landed wait in a heap of pending arrivals
+until they are ready, and are then moved into a heap of available
+aircraft at their airport.  A departure takes an available aircraft
+from its origin if there is one, otherwise a new aircraft is added to
+the fleet.  Since an aircraft that is free at some time stays free
+later on, this greedy sweep gives the minimum fleet size.
+"""
+
+import argparse
+import heapq
+import random
+
+from flight_utils import *
+
+turnaround_time = 0.75          # hours between landing and the next departure
+day_start = 6.0                 # first departure of the day (hours)
+day_end = 22.0                  # last departure of the day (hours)
+
+
+def block_time(city_list):
+    """Hours from departure at the first city to arrival at the last
+    one, including layovers at the intermediate stops."""
+    total_time = 0
+    for c1, c2 in zip(city_list[:-1], city_list[1:]):
+        flight_time, _ = calculate_flight_time(airports[c1]['lon'], airports[c1]['lat'],
+                                               airports[c2]['lon'], airports[c2]['lat'])
+        total_time += flight_time
+    n_stops = len(city_list) - 2
+    return total_time + layover_time_per_stop * n_stops
+
+
+def departure_time(record, rng):
+    """The departure_time of the record (in hours) if it has one,
+    otherwise a random time of the operating day from rng."""
+    if 'departure_time' in record:
+        return float(record['departure_time'])
+    # random departures on a 5 minute grid
+    return day_start + round(rng.uniform(0, day_end - day_start) * 12) / 12
+
+
+def make_trips(flights, seed=None):
+    """Takes newstyle flight records and returns a list of trips, which
+    are tuples (departure, arrival, origin, destination, flight_number),
+    sorted by departure time."""
+    rng = random.Random(seed)
+    trips = []
+    for record in flights:
+        city_list = flight_path2city_list(record['flight_path'])
+        departure = departure_time(record, rng)
+        arrival = departure + block_time(city_list)
+        trips.append((departure, arrival, city_list[0], city_list[-1],
+                      record['flight_number']))
+    trips.sort()
+    return trips
+
+
+def schedule_fleet(trips):
+    """Chains the trips (sorted by departure) into aircraft rotations.
+    Returns the list of rotations, one per aircraft, each being a list
+    of trips."""
+    pending = []                # heap of (ready_time, aircraft, airport)
+    available = {}              # airport -> heap of (ready_time, aircraft)
+    rotations = []
+    for trip in trips:
+        departure, arrival, origin, destination, _ = trip
+        # everything that is ready by now joins its airport's pool
+        while pending and pending[0][0] <= departure:
+            ready_time, aircraft, airport = heapq.heappop(pending)
+            heapq.heappush(available.setdefault(airport, []), (ready_time, aircraft))
+        pool = available.get(origin)
+        if pool:
+            _, aircraft = heapq.heappop(pool)
+        else:
+            aircraft = len(rotations)
+            rotations.append([])
+        rotations[aircraft].append(trip)
+        heapq.heappush(pending, (arrival + turnaround_time, aircraft, destination))
+    return rotations
+
+
+def fleet_report(rotations):
+    """Prints the fleet size and utilization of the rotations; returns
+    the average utilization (block hours over the hours between the
+    first departure and the last arrival of the day)."""
+    if not rotations:
+        print('# no flights to schedule')
+        return 0.0
+    block_hours = sum(arrival - departure
+                      for rotation in rotations
+                      for departure, arrival, _, _, _ in rotation)
+    first_departure = min(rotation[0][0] for rotation in rotations)
+    last_arrival = max(trip[1] for rotation in rotations for trip in rotation)
+    span = last_arrival - first_departure
+    utilization = block_hours / (len(rotations) * span) if span > 0 else 0.0
+    n_trips = sum(len(rotation) for rotation in rotations)
+    print(f'# minimum fleet size: {len(rotations)} aircraft for {n_trips} flights')
+    print(f'# block hours: {block_hours:.2f}, operating span: {span:.2f} hours')
+    print(f'# average utilization: {100 * utilization:.1f}%,'
+          f' {n_trips / len(rotations):.2f} flights per aircraft')
+    return utilization
+
+
+def write_rotations(fname, rotations):
+    """Writes one line per aircraft with its sequence of flights."""
+    with open(fname, 'w') as fp:
+        for aircraft, rotation in enumerate(rotations):
+            legs = ', '.join(f'{flight_number} ({origin}-{destination}'
+                             f' {departure:.2f}-{arrival:.2f})'
+                             for departure, arrival, origin, destination, flight_number in rotation)
+            fp.write(f'aircraft {aircraft + 1}: {legs}\n')
+    print('# wrote aircraft rotations to file', fname)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute aircraft rotations and the minimum fleet size.')
+    parser.add_argument('flights_fname', nargs='?', default='profitable_flights.txt',
+                        help='newstyle flight file to schedule')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for the departure times')
+    parser.add_argument('--rotations', default='aircraft_rotations.txt',
+                        help='file in which to write the rotations')
+    args = parser.parse_args()
+
+    flights = load_flights_newstyle(args.flights_fname)
+    trips = make_trips(flights, seed=args.seed)
+    rotations = schedule_fleet(trips)
+    fleet_report(rotations)
+    write_rotations(args.rotations, rotations)
+
+
+if __name__ == '__main__':
+    main()
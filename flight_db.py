@@ -0,0 +1,248 @@
+#! /usr/bin/env python3
+
+"""Bulk export of flight files into SQLite, and reading them back.
+
+The newstyle "key: value" files are fine for the pipeline but awkward
+to query.  export_flights() loads any newstyle flight file into an
+SQLite database with two tables:
+
+    flights      one row per flight, in file order (flight_id), with
+                 the total distance and cost (as calc_cost() computes
+                 it) precomputed
+    flight_legs  one row per leg of every flight, with its distance,
+                 flight time and operating cost
+
+and indexes on origin, destination and passengers (and on the legs'
+airports).  Records are streamed from the file and inserted with
+executemany() in large transactions, with the database in WAL mode.
+Like the flight files, the database is built under a temporary name
+and renamed into place when complete.
+
+iter_flights_sqlite() reads the flights back as the same record
+dictionaries that iter_flights_newstyle() gives, with filters (origin,
+destination, passenger range) pushed down into the SQL query so only
+the matching rows are read.  iter_flights() takes either kind of file,
+so the scripts can be pointed at a database instead of a text file.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+
+from flight_utils import *
+
+db_suffixes = ('.db', '.sqlite', '.sqlite3')
+insert_batch = 50000            # records per transaction
+newstyle_fields = ('flight_number', 'origin', 'destination', 'passengers',
+                   'flight_path', 'n_stops')
+
+schema = """
+CREATE TABLE flights (
+    flight_id INTEGER PRIMARY KEY,
+    flight_number TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    passengers INTEGER NOT NULL,
+    flight_path TEXT NOT NULL,
+    n_stops INTEGER,
+    distance_nm REAL NOT NULL,
+    cost REAL NOT NULL,
+    extra TEXT
+);
+CREATE TABLE flight_legs (
+    flight_id INTEGER NOT NULL REFERENCES flights(flight_id),
+    leg_no INTEGER NOT NULL,
+    from_airport TEXT NOT NULL,
+    to_airport TEXT NOT NULL,
+    distance_nm REAL NOT NULL,
+    flight_time REAL NOT NULL,
+    cost REAL NOT NULL,
+    PRIMARY KEY (flight_id, leg_no)
+);
+"""
+
+indexes = """
+CREATE INDEX flights_origin ON flights(origin);
+CREATE INDEX flights_destination ON flights(destination);
+CREATE INDEX flights_passengers ON flights(passengers);
+CREATE INDEX flights_flight_number ON flights(flight_number);
+CREATE INDEX flight_legs_from ON flight_legs(from_airport);
+CREATE INDEX flight_legs_to ON flight_legs(to_airport);
+"""
+
+
+def is_db_fname(fname):
+    return fname.endswith(db_suffixes)
+
+
+def leg_values(c1, c2):
+    """Distance, flight time and operating cost of one leg."""
+    flight_time, cost = calculate_flight_time(airports[c1]['lon'], airports[c1]['lat'],
+                                              airports[c2]['lon'], airports[c2]['lat'])
+    return city2city_distance(c1, c2), flight_time, cost
+
+
+def flight_rows(flight_id, record, leg_cache):
+    """The flights row and the flight_legs rows of one record.  The
+    values of each leg are computed once and kept in leg_cache, since
+    the same legs come up again and again."""
+    city_list = flight_path2city_list(record['flight_path'])
+    legs = []
+    total_distance = 0
+    total_cost = 0
+    for leg_no, (c1, c2) in enumerate(zip(city_list[:-1], city_list[1:])):
+        if (c1, c2) not in leg_cache:
+            leg_cache[c1, c2] = leg_values(c1, c2)
+        distance_nm, flight_time, cost = leg_cache[c1, c2]
+        legs.append((flight_id, leg_no, c1, c2, distance_nm, flight_time, cost))
+        total_distance += distance_nm
+        total_cost += cost
+    # layover costs, as in calc_cost()
+    total_cost += layover_time_per_stop * (len(city_list) - 2) * layover_cost_per_hour
+    extra = {key: value for key, value in record.items() if key not in newstyle_fields}
+    n_stops = record.get('n_stops')
+    flight = (flight_id, record['flight_number'], record['origin'], record['destination'],
+              int(record['passengers']), record['flight_path'],
+              int(n_stops) if n_stops is not None else None,
+              total_distance, total_cost, json.dumps(extra) if extra else None)
+    return flight, legs
+
+
+def export_flights(flight_fname, db_fname, batch_size=insert_batch):
+    """Loads a newstyle flight file into a new SQLite database; returns
+    the number of flights."""
+    tmp_fname = f'{db_fname}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_fname):
+        os.remove(tmp_fname)
+    conn = sqlite3.connect(tmp_fname)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(schema)
+        flights, legs = [], []
+        leg_cache = {}
+        n_flights = 0
+
+        def insert():
+            with conn:
+                conn.executemany('INSERT INTO flights VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 flights)
+                conn.executemany('INSERT INTO flight_legs VALUES (?, ?, ?, ?, ?, ?, ?)', legs)
+            flights.clear()
+            legs.clear()
+
+        for flight_id, record in enumerate(iter_flights_newstyle(flight_fname)):
+            flight, flight_legs = flight_rows(flight_id, record, leg_cache)
+            flights.append(flight)
+            legs.extend(flight_legs)
+            n_flights += 1
+            if len(flights) >= batch_size:
+                insert()
+        insert()
+        # indexes are cheaper to build once the rows are in
+        with conn:
+            conn.executescript(indexes)
+        # fold the write-ahead log back into the database file and
+        # leave it in rollback mode, so the database is a single file
+        # that can be renamed into place and opened read-only
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('PRAGMA journal_mode=DELETE')
+    except BaseException:
+        conn.close()
+        os.remove(tmp_fname)
+        raise
+    conn.close()
+    os.replace(tmp_fname, db_fname)
+    return n_flights
+
+
+def flight_filters(origin=None, destination=None, min_passengers=None, max_passengers=None):
+    """The WHERE clause and parameters for the filters that are set."""
+    clauses, params = [], []
+    for column, op, value in [('origin', '=', origin), ('destination', '=', destination),
+                              ('passengers', '>=', min_passengers),
+                              ('passengers', '<=', max_passengers)]:
+        if value is not None:
+            clauses.append(f'{column} {op} ?')
+            params.append(value)
+    where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    return where, params
+
+
+def iter_flights_sqlite(db_fname, origin=None, destination=None,
+                        min_passengers=None, max_passengers=None):
+    """Yields the flights of the database (in file order) that pass the
+    filters, as newstyle record dictionaries."""
+    where, params = flight_filters(origin, destination, min_passengers, max_passengers)
+    conn = sqlite3.connect(f'file:{db_fname}?mode=ro', uri=True)
+    try:
+        cursor = conn.execute('SELECT flight_number, origin, destination, passengers,'
+                              ' flight_path, n_stops, extra FROM flights'
+                              + where + ' ORDER BY flight_id', params)
+        for row in cursor:
+            *values, extra = row
+            record = {key: str(value) for key, value in zip(newstyle_fields, values)
+                      if value is not None}
+            if extra is not None:
+                record.update(json.loads(extra))
+            yield record
+    finally:
+        conn.close()
+
+
+def iter_flights(fname, origin=None, destination=None,
+                 min_passengers=None, max_passengers=None):
+    """Flights from either a newstyle flight file or a database
+    (chosen by the file name), with the same filters.  On a database
+    the filters are done by SQLite; on a text file every record is
+    still read."""
+    if is_db_fname(fname):
+        yield from iter_flights_sqlite(fname, origin, destination,
+                                       min_passengers, max_passengers)
+        return
+    for record in iter_flights_newstyle(fname):
+        if origin is not None and record['origin'] != origin:
+            continue
+        if destination is not None and record['destination'] != destination:
+            continue
+        passengers = int(record['passengers'])
+        if min_passengers is not None and passengers < min_passengers:
+            continue
+        if max_passengers is not None and passengers > max_passengers:
+            continue
+        yield record
+
+
+def add_filter_arguments(parser):
+    """The filter options shared by the scripts that read flights
+    through iter_flights()."""
+    parser.add_argument('--origin', default=None, help='only flights from this airport')
+    parser.add_argument('--destination', default=None, help='only flights to this airport')
+    parser.add_argument('--min-passengers', type=int, default=None,
+                        help='only flights with at least this many passengers')
+    parser.add_argument('--max-passengers', type=int, default=None,
+                        help='only flights with at most this many passengers')
+
+
+def filter_args(args):
+    """The filters from the parsed arguments, as keyword arguments of
+    iter_flights()."""
+    return {'origin': args.origin, 'destination': args.destination,
+            'min_passengers': args.min_passengers, 'max_passengers': args.max_passengers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a newstyle flight file into an SQLite database.')
+    parser.add_argument('flights_fname', nargs='?', default='sorted_flights_new.txt',
+                        help='newstyle flight file to export')
+    parser.add_argument('db_fname', nargs='?', default=None,
+                        help='database to create (default: the flight file name with .db)')
+    args = parser.parse_args()
+    db_fname = args.db_fname or os.path.splitext(args.flights_fname)[0] + '.db'
+    n_flights = export_flights(args.flights_fname, db_fname)
+    print(f'# exported {n_flights} flights to {db_fname}')
+
+
+if __name__ == '__main__':
+    main()
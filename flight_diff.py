@@ -0,0 +1,111 @@
+#! /usr/bin/env python3
+
+"""Compares two flight files, for example generated_flights_new.txt
+against sorted_flights_new.txt, or sorted_flights_new.txt against
+profitable_flights.txt.
+
+The smaller file (by size on disk) is loaded into a hash table keyed
+on flight_number, then the other file is streamed past it one record
+at a time, so the time is linear and only the smaller file is ever in
+memory.  We report the flights that were removed or added, the paths
+that were reordered (same airports) or rerouted (different airports)
+with the change in distance, the passenger changes (for instance from
+accommodate_passengers()), and the change in total profit.
+"""
+
+import argparse
+import os
+
+from flight_utils import *
+from flight_optimization import calc_cost, calc_income
+
+
+def summarize_record(record):
+    """The parts of a record that we compare."""
+    city_list = flight_path2city_list(record['flight_path'])
+    return {'flight_path': ', '.join(city_list),
+            'passengers': int(record['passengers']),
+            'distance_nm': calc_distance_new(city_list),
+            'profit': calc_income(record) - calc_cost(record)}
+
+
+def diff_flight_files(old_fname, new_fname, report=print):
+    """Hash-joins the two files on flight_number.  Calls report() with a
+    line for every difference and returns a dictionary of totals."""
+    # hash the smaller file, stream the larger one
+    swapped = os.path.getsize(old_fname) > os.path.getsize(new_fname)
+    hashed_fname, streamed_fname = (new_fname, old_fname) if swapped else (old_fname, new_fname)
+    hashed = {}
+    for record in iter_flights_newstyle(hashed_fname):
+        hashed[record['flight_number']] = summarize_record(record)
+
+    totals = {'removed': 0, 'added': 0, 'reordered': 0, 'rerouted': 0,
+              'passenger_changes': 0, 'passenger_delta': 0, 'distance_delta': 0.0,
+              'old_profit': 0.0, 'new_profit': 0.0}
+
+    def compare(flight_number, old, new):
+        if old is None:
+            totals['added'] += 1
+            totals['new_profit'] += new['profit']
+            report(f"ADDED: Flight {flight_number}: {new['flight_path']}")
+            return
+        if new is None:
+            totals['removed'] += 1
+            totals['old_profit'] += old['profit']
+            report(f"REMOVED: Flight {flight_number}: {old['flight_path']}")
+            return
+        totals['old_profit'] += old['profit']
+        totals['new_profit'] += new['profit']
+        if old['flight_path'] != new['flight_path']:
+            distance_delta = new['distance_nm'] - old['distance_nm']
+            totals['distance_delta'] += distance_delta
+            old_cities = flight_path2city_list(old['flight_path'])
+            new_cities = flight_path2city_list(new['flight_path'])
+            kind = 'REORDERED' if sorted(old_cities) == sorted(new_cities) else 'REROUTED'
+            totals[kind.lower()] += 1
+            report(f"{kind}: Flight {flight_number}: {old['flight_path']} -> {new['flight_path']}"
+                   f"   ({distance_delta:+.2f} nm)")
+        if old['passengers'] != new['passengers']:
+            totals['passenger_changes'] += 1
+            totals['passenger_delta'] += new['passengers'] - old['passengers']
+            report(f"PASSENGERS: Flight {flight_number}: {old['passengers']} -> {new['passengers']}")
+
+    for record in iter_flights_newstyle(streamed_fname):
+        streamed = summarize_record(record)
+        matched = hashed.pop(record['flight_number'], None)
+        if swapped:
+            compare(record['flight_number'], streamed, matched)
+        else:
+            compare(record['flight_number'], matched, streamed)
+    # whatever is left in the hash table is only in the hashed file
+    for flight_number, leftover in hashed.items():
+        if swapped:
+            compare(flight_number, None, leftover)
+        else:
+            compare(flight_number, leftover, None)
+    totals['profit_delta'] = totals['new_profit'] - totals['old_profit']
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two flight files by flight_number.')
+    parser.add_argument('old_fname', help='the earlier flight file, e.g. generated_flights_new.txt')
+    parser.add_argument('new_fname', help='the later flight file, e.g. profitable_flights.txt')
+    parser.add_argument('--summary', action='store_true',
+                        help='only print the totals, not every difference')
+    args = parser.parse_args()
+
+    report = (lambda line: None) if args.summary else print
+    totals = diff_flight_files(args.old_fname, args.new_fname, report)
+    print(f"# {args.old_fname} -> {args.new_fname}")
+    print(f"# removed: {totals['removed']}, added: {totals['added']}")
+    print(f"# reordered: {totals['reordered']}, rerouted: {totals['rerouted']},"
+          f" distance change {totals['distance_delta']:+.2f} nm")
+    print(f"# passenger changes: {totals['passenger_changes']},"
+          f" net {totals['passenger_delta']:+d} passengers")
+    print(f"# total profit: ${totals['old_profit']:.2f} -> ${totals['new_profit']:.2f}"
+          f" ({totals['profit_delta']:+.2f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,45 @@
 #! /usr/bin/env python3
 
+import argparse
 import random
 from math import radians, sin, cos, sqrt, atan2
 
 from flight_utils import *
+from demand_model import gravity_demand_for_airports
+from memory_profile import memory_budget, add_memory_arguments, setup_memory, exit_on_budget_exceeded
 
 def simulate_layover(stops, flight_time, operational_cost):
     """Simulate layover time and calculate maintenance cost."""
     layover_time = 0
     maintenance_cost = 0
     if stops > 0:
-        layover_time = 1.5 * stops  # Layover time in hours
-        maintenance_cost_per_hour = 150  # Maintenance cost per hour
-        maintenance_cost = (layover_time * maintenance_cost_per_hour) + operational_cost
+        layover_time = layover_time_per_stop * stops  # Layover time in hours
+        maintenance_cost = (layover_time * layover_cost_per_hour) + operational_cost
     else:
         maintenance_cost = operational_cost
     return layover_time, maintenance_cost
 
-def main():
-    # Initialize variables
-    routes = []
+def generate_routes(airport_table=airports, sample_fraction=None, seed=None,
+                    demand=None):
+    """Generator that yields the (oldstyle) route dictionaries one at a
+    time, so that the caller can stream them to a file without holding
+    the whole network in memory.  If sample_fraction is given, each
+    origin/destination pair is kept with that probability.  seed makes
+    the run reproducible.  demand can be a (code2index, matrix) pair
+    from demand_model.gravity_demand_for_airports(); otherwise the
+    number of passengers is random."""
+    rng = random.Random(seed)
+    airport_codes = list(airport_table.keys())
     route_id = 1
-    total_passenger_miles = 0
 
     # Generate all possible routes
-    for origin_code, origin_data in airports.items():
-        for dest_code, dest_data in airports.items():
+    for origin_code, origin_data in airport_table.items():
+        for dest_code, dest_data in airport_table.items():
             if origin_code == dest_code:  # Ensure origin and destination are different
                 continue
+            # optionally keep only a random subset of the O/D pairs
+            if sample_fraction is not None and rng.random() >= sample_fraction:
+                continue
 
             # Initialize distance and time
             total_distance_nm = 0
@@ -37,15 +49,19 @@ def main():
             # Determine number of stops based on distance
             distance_nm = haversine_distance_nm(origin_data['lat'], origin_data['lon'], dest_data['lat'], dest_data['lon'])
             if distance_nm > 434.488:  # 500 miles in nautical miles
-                possible_stops = [code for code in airports.keys() if code not in [origin_code, dest_code]]
-                stops = random.randint(0, min(2, len(possible_stops)))
-                stop_cities = random.sample(possible_stops, stops)
+                n_possible_stops = len(airport_codes) - 2
+                stops = rng.randint(0, min(2, n_possible_stops))
+                # draw two extra codes so that we still have enough
+                # after dropping the origin and destination; this avoids
+                # building a list of all other airports for every pair
+                stop_cities = [code for code in rng.sample(airport_codes, stops + 2)
+                               if code not in (origin_code, dest_code)][:stops]
                 
                 stop1 = stop_cities[0] if stops >= 1 else 'None'
                 stop2 = stop_cities[1] if stops >= 2 else 'None'
                 
-                stop1_data = airports.get(stop1, {'lat': None, 'lon': None})
-                stop2_data = airports.get(stop2, {'lat': None, 'lon': None})
+                stop1_data = airport_table.get(stop1, {'lat': None, 'lon': None})
+                stop2_data = airport_table.get(stop2, {'lat': None, 'lon': None})
 
                 if stop1 != 'None' and None not in [stop1_data['lat'], stop1_data['lon']]:
                     # Calculate distance and time for origin to stop1
@@ -98,19 +114,22 @@ def main():
             # Simulate layover and calculate maintenance cost
             layover_time, maintenance_cost = simulate_layover(stops, total_flight_time, total_operating_cost)
 
-            # Random number of passengers (20 to 204)
-            passengers = random.randint(20, 204)
+            if demand is not None:
+                # Passengers from the gravity demand model
+                code2index, demand_matrix = demand
+                passengers = int(demand_matrix[code2index[origin_code], code2index[dest_code]])
+            else:
+                # Random number of passengers (20 to seat capacity)
+                passengers = rng.randint(20, seat_capacity)
 
             # Calculate income for the flight
-            ticket_price = 384.85  # Ticket price from Bureau of Transportation
-            flight_income = ticket_price * passengers
+            flight_income = avg_ticket_price * passengers
 
             # Calculate net profit
             net_profit = flight_income - maintenance_cost
 
             # Calculate total passenger miles
             passenger_miles = passengers * total_distance_nm
-            total_passenger_miles += passenger_miles
 
             # Prepare route data
             route_data = {
@@ -139,46 +158,108 @@ def main():
                 'Passenger_Miles': passenger_miles
             }
             
-            # Append route data to routes list
-            routes.append(route_data)
+            yield route_data
             route_id += 1
 
+
+def format_oldstyle_route(route):
+    """Formats a route in the legacy flights.txt layout."""
+    lines = []
+    lines.append(f"Flight: {route['Route']}\n")
+    lines.append(f"Flight Path: {route['Origin']}, {route['Stop1']}, {route['Stop2']}, {route['Destination']}\n")
+    lines.append(f"Origin: {route['Origin']}\n")
+    lines.append(f"Origin Coordinates: {route['Origin_Latitude']}, {route['Origin_Longitude']}\n")
+    lines.append(f"Destination: {route['Destination']}\n")
+    lines.append(f"Destination Coordinates: {route['Destination_Latitude']}, {route['Destination_Longitude']}\n")
+    lines.append(f"Stops: {route['Stops']}\n")
+    if route['Stop1'] != 'None':
+        lines.append(f"Stop1: {route['Stop1']}\n")
+        lines.append(f"Stop1 Coordinates: {route['Stop1_Latitude']},{route['Stop1_Longitude']}\n")
+    else:
+        lines.append(f"Stop1: {route['Stop1']}\n")
+    if route['Stop2'] != 'None':
+        lines.append(f"Stop2: {route['Stop2']}\n")
+        lines.append(f"Stop2 Coordinates: {route['Stop2_Latitude']},{route['Stop2_Longitude']}\n")
+    else:
+        lines.append(f"Stop2: {route['Stop2']}\n")
+    lines.append(f"Passengers: {route['Passengers']}\n")
+    lines.append(f"Distance (Nautical Miles): {route['Distance_Nautical_Miles']:.2f}\n")
+    lines.append(f"Flight Time (Hours): {route['Flight_Time']:.2f}\n")
+    lines.append(f"Operating Cost: ${route['Operating_Cost']:.2f}\n")
+    lines.append(f"Layover Time (Hours): {route['Layover_Time']:.2f}\n")
+    lines.append(f"Maintenance Cost: ${route['Maintenance_Cost']:.2f}\n")
+    lines.append(f"Income of Flight: ${route['Flight_Income']:.2f}\n")
+    lines.append(f"Net Profit of the Flight: ${route['Net_Profit']:.2f}\n")
+    lines.append(f"Total Passenger Miles: {route['Passenger_Miles']:.2f} passenger miles.\n")
+    lines.append("\n")
+    return ''.join(lines)
+
+
+def stream_routes(routes, writers):
+    """Sends every route to every writer as it comes out of the routes
+    iterable; returns the number of routes and the total passenger
+    miles."""
+    n_routes = 0
+    total_passenger_miles = 0
+    for route in routes:
+        for writer in writers:
+            writer.write(route)
+        n_routes += 1
+        total_passenger_miles += route['Passenger_Miles']
+    return n_routes, total_passenger_miles
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate all possible flight routes.')
+    parser.add_argument('--sample', type=float, default=None,
+                        help='keep only this fraction (0-1) of the origin/destination pairs')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed, for reproducible runs')
+    parser.add_argument('--no-legacy', action='store_true',
+                        help='do not write the oldstyle flights.txt file')
+    parser.add_argument('--gravity', action='store_true',
+                        help='take passengers from the population gravity model instead of at random')
+    parser.add_argument('--out', default='generated_flights_new.txt',
+                        help='file in which to write the newstyle routes; - writes them to'
+                             ' stdout, as they are generated, for a pipeline')
+    add_memory_arguments(parser)
+    args = parser.parse_args()
+    profiler = setup_memory(args, 'flight_generator')
+    with exit_on_budget_exceeded(), diagnostics_to_stderr(args.out):
+        generate_stage(args, profiler)
+
+
+def generate_stage(args, profiler):
+    demand = None
+    if args.gravity:
+        # a few airports x airports float matrices while it is built
+        memory_budget.require(4 * 8 * len(airports) ** 2, 'the gravity demand matrix')
+        with profiler.step('gravity demand'):
+            demand = gravity_demand_for_airports(airports.keys(), seed=args.seed)
+    routes = generate_routes(sample_fraction=args.sample, seed=args.seed,
+                             demand=demand)
+
     # write new format alongside old one
-    fname = 'generated_flights_new.txt'
-    write_flights_oldstyle2newstyle(fname, routes)
-            
-    # Write data to a text file
-    with open('flights.txt', 'w') as fp:
-        for route in routes:
-            # append_route(fp, route)
-            fp.write(f"Flight: {route['Route']}\n")
-            fp.write(f"Flight Path: {route['Origin']}, {route['Stop1']}, {route['Stop2']}, {route['Destination']}\n")
-            fp.write(f"Origin: {route['Origin']}\n")
-            fp.write(f"Origin Coordinates: {route['Origin_Latitude']}, {route['Origin_Longitude']}\n")
-            fp.write(f"Destination: {route['Destination']}\n")
-            fp.write(f"Destination Coordinates: {route['Destination_Latitude']}, {route['Destination_Longitude']}\n")
-            fp.write(f"Stops: {route['Stops']}\n")
-            if route['Stop1'] != 'None':
-                fp.write(f"Stop1: {route['Stop1']}\n")
-                fp.write(f"Stop1 Coordinates: {route['Stop1_Latitude']},{route['Stop1_Longitude']}\n")
-            else:
-                fp.write(f"Stop1: {route['Stop1']}\n")
-            if route['Stop2'] != 'None':
-                fp.write(f"Stop2: {route['Stop2']}\n")
-                fp.write(f"Stop2 Coordinates: {route['Stop2_Latitude']},{route['Stop2_Longitude']}\n")
-            else:
-                fp.write(f"Stop2: {route['Stop2']}\n")
-            fp.write(f"Passengers: {route['Passengers']}\n")
-            fp.write(f"Distance (Nautical Miles): {route['Distance_Nautical_Miles']:.2f}\n")
-            fp.write(f"Flight Time (Hours): {route['Flight_Time']:.2f}\n")
-            fp.write(f"Operating Cost: ${route['Operating_Cost']:.2f}\n")
-            fp.write(f"Layover Time (Hours): {route['Layover_Time']:.2f}\n")
-            fp.write(f"Maintenance Cost: ${route['Maintenance_Cost']:.2f}\n")
-            fp.write(f"Income of Flight: ${route['Flight_Income']:.2f}\n")
-            fp.write(f"Net Profit of the Flight: ${route['Net_Profit']:.2f}\n")
-            fp.write(f"Total Passenger Miles: {route['Passenger_Miles']:.2f} passenger miles.\n")
-            fp.write("\n")
-    print("All possible flight routes data generated and saved to flights.txt")
+    fname = args.out
+    writers = [FlightFileWriter(fname, format_oldstyle_route2newstyle)]
+    if not args.no_legacy:
+        writers.append(FlightFileWriter('flights.txt', format_oldstyle_route, separator=''))
+    try:
+        with profiler.step('generate and write'):
+            n_routes, total_passenger_miles = stream_routes(routes, writers)
+    except BaseException:
+        # don't leave half-written files behind
+        for writer in writers:
+            writer.abort()
+        raise
+    with profiler.step('close'):
+        for writer in writers:
+            writer.close()
+    print('# wrote newstyle routes to file', fname)
+    print(f'# generated {n_routes} routes, {total_passenger_miles:.2f} total passenger miles')
+    if not args.no_legacy:
+        print("All possible flight routes data generated and saved to flights.txt")
+    profiler.report()
 
 
 if __name__ == '__main__':
@@ -2,12 +2,15 @@
 
 """Visualization and Anayzing of the Levels of Optimizations"""
 
+import argparse
 import matplotlib.pyplot as plt
 from flight_utils import *
+from flight_db import iter_flights, add_filter_arguments, filter_args
 
-# Step 1: Load and parse the data
-def load_flights(file_path):
-    return load_flights_newstyle(file_path)
+# Step 1: Load and parse the data (a newstyle flight file or a
+# flight_db.py database, optionally filtered)
+def load_flights(file_path, **filters):
+    return list(iter_flights(file_path, **filters))
 
 # Step 2: Calculate total passenger miles
 def calculate_total_passenger_miles(flights):
@@ -22,10 +25,9 @@ def calculate_total_passenger_miles(flights):
 
 # Step 3: Calculate total net profit
 def calculate_income(record):
-    """Calculate the income from a flight record based on the number of passengers and average ticket price."""
-    avg_ticket_price = 384.85  # Average ticket price in dollars
+    """Calculate the income from a flight record based on the number of passengers and its fare (or the average ticket price)."""
     passengers = int(record['passengers'])
-    income = avg_ticket_price * passengers
+    income = record_fare(record) * passengers
     return income
 
 def calculate_total_net_profit(flights):
@@ -61,13 +63,19 @@ def calculate_total_passengers(flights):
     return total_passengers
 
 # Files to be processed
-files = ['generated_flights_new.txt', 'sorted_flights_new.txt', 'profitable_flights.txt']
+parser = argparse.ArgumentParser(description='Plot passenger miles, net profit and passengers per flight file.')
+parser.add_argument('files', nargs='*',
+                    default=['generated_flights_new.txt', 'sorted_flights_new.txt', 'profitable_flights.txt'],
+                    help='newstyle flight files or flight_db.py databases')
+add_filter_arguments(parser)
+args = parser.parse_args()
+files = args.files
 
 # Store results
 results = []
 
 for file in files:
-    flights = load_flights(file)
+    flights = load_flights(file, **filter_args(args))
     total_passenger_miles = calculate_total_passenger_miles(flights)
     total_net_profit = calculate_total_net_profit(flights)
     total_passengers = calculate_total_passengers(flights)
@@ -0,0 +1,151 @@
+#! /usr/bin/env python3
+
+"""Random access into a newstyle flight file.
+
+One scan of the file builds a sidecar index (the flight file name
+plus .idx, in JSON) with the byte offset and length of every record,
+and which records belong to each flight_number, origin and
+destination.  IndexedFlightFile then seeks straight to the records it
+is asked for and parses only those, instead of loading the whole file.
+
+The index remembers the size and modification time of the flight
+file, and is rebuilt when they change.  Compressed (.gz/.xz) files
+can't be seeked into cheaply, so they aren't supported.
+"""
+
+import sys
+import argparse
+import json
+import os
+
+from flight_utils import *
+
+record_separator = b'__FLIGHT_RECORD_SEPARATOR__'
+
+
+def index_fname(fname):
+    return fname + '.idx'
+
+
+def build_flight_index(fname):
+    """Scans the flight file once and returns the index dictionary."""
+    if fname.endswith('.gz') or fname.endswith('.xz'):
+        raise ValueError(f'cannot index compressed flight file {fname}')
+    records = []
+    by_key = {'flight_number': {}, 'origin': {}, 'destination': {}}
+
+    def add_record(start, end, fields):
+        record_no = len(records)
+        records.append([start, end - start])
+        if 'flight_number' in fields:
+            by_key['flight_number'][fields['flight_number']] = record_no
+        for key in ['origin', 'destination']:
+            if key in fields:
+                by_key[key].setdefault(fields[key], []).append(record_no)
+
+    offset = 0
+    start = 0
+    fields = {}
+    has_content = False
+    with open(fname, 'rb') as fp:
+        for line in fp:
+            if line.strip() == record_separator:
+                add_record(start, offset, fields)
+                start = offset + len(line)
+                fields = {}
+                has_content = False
+            else:
+                if line.strip():
+                    has_content = True
+                key, sep, value = line.partition(b':')
+                key = key.strip().decode()
+                if sep and key in by_key:
+                    fields[key] = value.strip().decode()
+            offset += len(line)
+    if has_content:
+        add_record(start, offset, fields)
+    stat = os.stat(fname)
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'records': records}
+    index.update(by_key)
+    return index
+
+
+def load_flight_index(fname):
+    """Returns the index of the flight file, reading the sidecar file
+    if it is up to date, and (re)building and saving it otherwise."""
+    stat = os.stat(fname)
+    if os.path.exists(index_fname(fname)):
+        with open(index_fname(fname), 'r') as fp:
+            index = json.load(fp)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+            return index
+    index = build_flight_index(fname)
+    with open(index_fname(fname), 'w') as fp:
+        json.dump(index, fp)
+    return index
+
+
+class IndexedFlightFile:
+    """A flight file that we can look records up in without parsing
+    all of it."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.index = load_flight_index(fname)
+        self.fp = open(fname, 'rb')
+
+    def read_record(self, record_no):
+        offset, length = self.index['records'][record_no]
+        self.fp.seek(offset)
+        return parse_record(self.fp.read(length).decode())
+
+    def get(self, flight_number):
+        """The record of the given flight, or None if there's no such
+        flight."""
+        record_no = self.index['flight_number'].get(str(flight_number))
+        if record_no is None:
+            return None
+        return self.read_record(record_no)
+
+    def from_origin(self, code):
+        return [self.read_record(n) for n in self.index['origin'].get(code, [])]
+
+    def to_destination(self, code):
+        return [self.read_record(n) for n in self.index['destination'].get(code, [])]
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Look up flights in a flight file through its index.')
+    parser.add_argument('flights_fname', help='newstyle flight file')
+    parser.add_argument('flight_numbers', nargs='*', help='flight numbers to show')
+    parser.add_argument('--origin', help='show all flights from this airport')
+    parser.add_argument('--destination', help='show all flights to this airport')
+    args = parser.parse_args()
+
+    with IndexedFlightFile(args.flights_fname) as flight_file:
+        found = []
+        for flight_number in args.flight_numbers:
+            record = flight_file.get(flight_number)
+            if record is None:
+                print(f'# no flight {flight_number} in {args.flights_fname}')
+            else:
+                found.append(record)
+        if args.origin:
+            found.extend(flight_file.from_origin(args.origin))
+        if args.destination:
+            found.extend(flight_file.to_destination(args.destination))
+        sys.stdout.write('__FLIGHT_RECORD_SEPARATOR__\n'.join(
+            format_newstyle_route(record) for record in found))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,41 +17,132 @@ and pick the path with the best metric, and advertise what the
 replacement path is.
 
 This program follows the new style of formatting.
+
+Given - as its input file it reads the flights from stdin, and writes
+the profitable ones to stdout, so that it can be the last stage of a
+shell pipeline.  The pruning is done as the flights come in; only the
+replacement search has to wait for all of them, since any profitable
+flight can be the closest match.  With --no-replace there is no
+replacement search and each profitable flight is passed on as soon as
+it is read.
 """
 
 import sys
+import argparse
 import pprint
 import numpy as np
 from math import radians, sin, cos, sqrt, atan2
 
 from flight_utils import *
+from stage_cache import StageCache, stage_key, code_version
+from flight_db import iter_flights, add_filter_arguments, filter_args, is_db_fname
+from memory_profile import (memory_budget, flight_file_memory, add_memory_arguments, setup_memory,
+                           exit_on_budget_exceeded)
+
+# Flights with profits less than this value get eliminated
+profit_threshold = 10000  # Change this value to the desired threshold
 
 def main():
     """Load all the sorted flights, then do the elimination, then do the
     replacement."""
-    sorted_fname = 'sorted_flights_new.txt'
-    if len(sys.argv) > 2:
-        raise Exception('Too many arguments')
-    elif len(sys.argv) == 2:
-        sorted_fname = sys.argv[1]
+    parser = argparse.ArgumentParser(description='Prune unprofitable flights and find their replacements.')
+    parser.add_argument('sorted_fname', nargs='?', default='sorted_flights_new.txt',
+                        help='newstyle flight file (or flight_db.py database) to prune;'
+                             ' - reads it from stdin')
+    parser.add_argument('--out', default=None,
+                        help='file in which to write the profitable flights (default'
+                             ' profitable_flights.txt); - writes them to stdout (the default'
+                             ' when reading stdin)')
+    parser.add_argument('--no-replace', action='store_true',
+                        help='only prune: no replacement paths, and no passengers moved to them')
+    parser.add_argument('--risk-aversion', type=float, default=None,
+                        help='prune on simulated expected profit minus this many standard deviations')
+    parser.add_argument('--draws', type=int, default=10000,
+                        help='Monte Carlo draws per flight for --risk-aversion')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for the Monte Carlo simulation')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always redo the pruning, even if the stage cache has the result')
+    add_filter_arguments(parser)
+    add_memory_arguments(parser)
+    args = parser.parse_args()
+    sorted_fname = args.sorted_fname
+    profiler = setup_memory(args, 'flight_optimization')
+    if args.out is not None:
+        fname_out = args.out
+    else:
+        fname_out = '-' if sorted_fname == '-' else 'profitable_flights.txt'
+    # a pipeline stage has no input file to key the cache on, nor an
+    # output file to restore
+    streaming = '-' in (sorted_fname, fname_out)
+    # an unseeded simulation gives a different answer every time
+    use_cache = (not args.no_cache and not streaming
+                 and (args.risk_aversion is None or args.seed is not None))
+    if use_cache:
+        cache = StageCache()
+        params = {'profit_threshold': profit_threshold, 'risk_aversion': args.risk_aversion,
+                  'draws': args.draws, 'seed': args.seed, 'replace': not args.no_replace,
+                  **filter_args(args)}
+        key = stage_key('flight_optimization', [sorted_fname], params,
+                        code_version('flight_optimization', 'flight_utils', 'flight_db',
+                                     'profit_simulation', 'cost_model'))
+        if cache.lookup(key, [fname_out]):
+            print(f'# {sorted_fname} unchanged, restored {fname_out} from the stage cache')
+            return
+    with exit_on_budget_exceeded(), diagnostics_to_stderr(fname_out):
+        prune_stage(args, sorted_fname, fname_out, profiler)
+        if use_cache:
+            cache.store(key, [fname_out])
+        profiler.report()
+
+def prune_stage(args, sorted_fname, fname_out, profiler):
     # get the reordered but un-pruned list from file -- this file,
-    # typically, has been generated by sort_flights_by_distance.py
-    all_flights = load_flights_newstyle(sorted_fname)
-    profitable, eliminated = prune_unprofitable_flights(all_flights)
-    # now generate a list of "replacement flightpaths" -- these are
-    # paths from the profitable list that come as close as possible to
-    # the eliminated list
-    replacement_dict = find_replacement_paths(profitable, eliminated)
-    print('========== REPLACEMENT_DICT ===========')
-    pprint.pprint(replacement_dict)
-    print('====== DONE REPLACEMENT_DICT ========')
-
-    # Accommodate passengers from eliminated flights to their replacements
-    passengers = accommodate_passengers(profitable, eliminated, replacement_dict)
+    # typically, has been generated by sort_flights_by_distance.py,
+    # possibly exported to a database by flight_db.py, or comes
+    # through a pipe from it
+    all_flights = iter_flights(sorted_fname, **filter_args(args))
+    needs_all_flights = args.risk_aversion is not None or not args.no_replace
+    if needs_all_flights and sorted_fname != '-' and not is_db_fname(sorted_fname):
+        # the simulation and the replacement search need every
+        # (profitable) flight at once
+        memory_budget.require(flight_file_memory(sorted_fname), f'loading {sorted_fname}',
+                              advice='sharded_pipeline.py prunes it one shard at a time,'
+                                     ' or --no-replace streams it')
+    profit_of = None
+    if args.risk_aversion is not None:
+        with profiler.step('load'):
+            all_flights = list(all_flights)
+        # imported here since the simulation imports this module
+        from profit_simulation import risk_adjusted_profits
+        with profiler.step('simulate'):
+            profit_of = risk_adjusted_profits(all_flights, args.risk_aversion,
+                                              n_draws=args.draws, seed=args.seed)
+    if args.no_replace:
+        # nothing needs the other flights: each profitable one is
+        # written out as soon as it is read
+        with profiler.step('prune (streaming)'):
+            write_flights_newstyle(fname_out, (record for record, profit
+                                               in iter_flight_profits(all_flights, profit_of)
+                                               if profit >= profit_threshold))
+        print('# wrote_profitable_files:', fname_out)
+        return
+    with profiler.step('load and prune'):
+        profitable, eliminated = prune_unprofitable_flights(all_flights, profit_of)
+    with profiler.step('replace'):
+        # now generate a list of "replacement flightpaths" -- these are
+        # paths from the profitable list that come as close as possible to
+        # the eliminated list
+        replacement_dict = find_replacement_paths(profitable, eliminated)
+        print('========== REPLACEMENT_DICT ===========')
+        pprint.pprint(replacement_dict)
+        print('====== DONE REPLACEMENT_DICT ========')
+
+        # Accommodate passengers from eliminated flights to their replacements
+        passengers = accommodate_passengers(profitable, eliminated, replacement_dict)
      
     # finally, save the profitable file, and a file describing replacements
-    fname_out = 'profitable_flights.txt'
-    write_flights_newstyle(fname_out, profitable)
+    with profiler.step('write'):
+        write_flights_newstyle(fname_out, profitable)
     print('# wrote_profitable_files:', fname_out)
     
 def find_replacement_paths(profitable, eliminated):
@@ -88,23 +179,35 @@ def calc_cumulative_distance_metric(clist_candidate, clist_eliminated):
         sum_of_min_distances += min(distances_to_candidates)
     return sum_of_min_distances
 
-def prune_unprofitable_flights(flight_list):
+def prune_unprofitable_flights(flight_list, profit_of=None):
     """Goes through the list, calculates all costs and income, and removes
-    those that fall under a cretain profit threshold."""
-    # Set the profit threshold to filter flights with profits less than this value
-    profit_threshold = 10000  # Change this value to the desired threshold
+    those that fall under a cretain profit threshold.  If profit_of is
+    given (a dictionary from flight_number to profit, such as the
+    risk-adjusted profits of the Monte Carlo simulation) it is used
+    instead of income minus cost."""
     profitable = []
     eliminated = []
-    for record in flight_list:
-        cost = calc_cost(record)
-        income = calc_income(record)
+    for record, profit in iter_flight_profits(flight_list, profit_of):
         # print(record['flight_path'], '   ', cost, '   ', income, '   ', income - cost)
-        if income - cost >= profit_threshold:
+        if profit >= profit_threshold:
             profitable.append(record)
         else:
             eliminated.append(record)
     return profitable, eliminated
 
+def iter_flight_profits(flight_list, profit_of=None):
+    """Yields (record, profit) for any iterable of flights, one at a
+    time as they are read; profit_of is as in
+    prune_unprofitable_flights()."""
+    for record in flight_list:
+        if profit_of is not None:
+            profit = profit_of[record['flight_number']]
+        else:
+            cost = calc_cost(record)
+            income = calc_income(record)
+            profit = income - cost
+        yield record, profit
+
 def calc_cost(record):
     """Looks at the flight record and calculate the costs costs for this
     flight path.
@@ -113,16 +216,15 @@ def calc_cost(record):
     # from the city list: (a) total flight length, which yields flight
     # time, which yields operational cost; (b) layover costs, which
     # depends on how many intermediate hubs you use.
-    speed_knots = 485  # Average speed of a Boeing 737 MAX in knots
+    aircraft = aircraft_types[default_aircraft]
     city_list = flight_path2city_list(record['flight_path'])
     distance_nm = calc_distance_new(city_list)
-    flight_time = distance_nm / speed_knots
-    operational_cost = 5757 * flight_time
+    flight_time = distance_nm / aircraft['speed_knots']
+    operational_cost = aircraft['cost_per_hour'] * flight_time
     # now that we have operational cost, we add something due to
     # layover time
     n_stops = len(city_list) - 2
-    layover_time_hr = 1.5 * n_stops  # from typical averages
-    layover_cost_per_hour = 150  # Maintenance cost per hour
+    layover_time_hr = layover_time_per_stop * n_stops
     layover_cost = (layover_time_hr * layover_cost_per_hour)
     # total cost comes from adding operational and layover
     total_cost = operational_cost + layover_cost
@@ -130,8 +232,8 @@ def calc_cost(record):
 
 def accommodate_passengers(profitable, eliminated, replacement_dict):
     """Accommodates passengers from eliminated flights to their replacement flights.
-    If the sum of passengers from the eliminated and replacement flights exceeds 204, 
-    the number of accommodated passengers is capped at 204.
+    If the sum of passengers from the eliminated and replacement flights exceeds the
+    seat capacity (204), the number of accommodated passengers is capped at it.
     """
     # Create a dictionary to keep track of updated passenger counts
     updated_passengers = {}
@@ -141,8 +243,8 @@ def accommodate_passengers(profitable, eliminated, replacement_dict):
         # Calculate the total number of passengers to accommodate
         accommodated_passengers = int(dead_record['passengers']) + int(replacement_record['passengers'])
         
-        if accommodated_passengers > 204:
-            accommodated_passengers = 204  # Cap at 204 if it exceeds
+        if accommodated_passengers > seat_capacity:
+            accommodated_passengers = seat_capacity  # Cap at capacity if it exceeds
         
         # Store the updated passenger count
         updated_passengers[replacement_record['flight_path']] = accommodated_passengers
@@ -155,10 +257,10 @@ def accommodate_passengers(profitable, eliminated, replacement_dict):
     return profitable 
 
 def calc_income(record):
-    """Looks at the number of passengers, take a typical ticket price, and
-    return the income."""
-    avg_ticket_price = 384.85
-    income = avg_ticket_price * int(record['passengers'])
+    """Looks at the number of passengers, take the ticket price (the
+    flight's fare if it has one, otherwise a typical one), and return
+    the income."""
+    income = record_fare(record) * int(record['passengers'])
     return income
    
 def main_previous(scoring_method='average') -> None:
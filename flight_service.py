@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+
+"""A long-running local HTTP/JSON service for route questions.
+
+Starting a script for every question means importing everything and
+re-parsing the flight files each time.  This service loads the
+airports, the distance matrix and the flight tables once (the sorted
+flights, split into profitable and eliminated with
+prune_unprofitable_flights()) and then answers queries, POSTed as
+JSON:
+
+    /distance     {"path": "DEN, ABQ, LAX"}           calc_distance_new()
+    /cost         {"path": ..., "passengers": 120}    calc_cost(), calc_income()
+    /reorder      {"path": ...}                       rearrange_cities_for_shortest_path()
+    /replacement  {"flight_number": "7"} or {"path": ...}
+                                                      find_closest_match()
+    /batch        {"queries": [{"op": "distance", "path": ...}, ...]}
+
+Paths can be given as a string or a list of airport codes, of at
+least 2 and at most max_path_airports known airports (reorder tries
+every order of the stops, so longer paths would take the service
+down).  A bad query gets a 400 answer, or an error entry in a batch,
+and a failure of our own a 500 one.  Answers
+are kept in an in-memory cache, and identical queries that arrive
+while one is being computed wait for that one instead of computing it
+again.  The slow queries (reorder, replacement) run in a worker
+thread so the server keeps answering the others.  The server only
+listens on localhost.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import numpy as np
+
+from flight_utils import *
+from flight_optimization import calc_cost, calc_income, prune_unprofitable_flights
+
+cache_size = 100000             # answers kept in the result cache
+max_path_airports = 9           # reorder lists 8! orders at most
+
+
+def error_message(e):
+    """Text of an error for the client; a KeyError is an airport code
+    or query field we don't know."""
+    if isinstance(e, KeyError):
+        return f'unknown airport or missing field: {e.args[0]}'
+    return str(e)
+
+
+class FlightService:
+    """The loaded tables and the query handlers."""
+
+    def __init__(self, flights_fname='sorted_flights_new.txt'):
+        self.airport_codes = list(airports.keys())
+        self.code2index = {code: i for i, code in enumerate(self.airport_codes)}
+        self.distance_matrix = haversine_distance_matrix_nm(
+            [airports[code]['lat'] for code in self.airport_codes],
+            [airports[code]['lon'] for code in self.airport_codes])
+        all_flights = load_flights_newstyle(flights_fname)
+        self.profitable, self.eliminated = prune_unprofitable_flights(all_flights)
+        self.eliminated_by_number = {record['flight_number']: record
+                                     for record in self.eliminated}
+        # the profitable city lists as a padded matrix of airport
+        # indices, for the replacement search
+        city_lists = [flight_path2city_list(record['flight_path'])
+                      for record in self.profitable]
+        max_len = max((len(cities) for cities in city_lists), default=1)
+        self.candidate_cities = np.zeros((len(city_lists), max_len), dtype=np.int64)
+        self.candidate_mask = np.zeros((len(city_lists), max_len), dtype=bool)
+        for i, cities in enumerate(city_lists):
+            self.candidate_cities[i, :len(cities)] = [self.code2index[c] for c in cities]
+            self.candidate_mask[i, :len(cities)] = True
+        self.cache = collections.OrderedDict()
+        self.in_flight = {}
+        self.n_queries = 0
+        self.n_cache_hits = 0
+
+    def city_list(self, query):
+        path = query['path']
+        if isinstance(path, str):
+            city_list = flight_path2city_list(path)
+        elif isinstance(path, list):
+            city_list = path
+        else:
+            raise ValueError('path must be a string or a list of airport codes')
+        if not 2 <= len(city_list) <= max_path_airports:
+            raise ValueError(f'path must have 2 to {max_path_airports} airports,'
+                             f' not {len(city_list)}')
+        unknown = [city for city in city_list if not isinstance(city, str) or city not in airports]
+        if unknown:
+            raise ValueError(f'unknown airports in path: {unknown}')
+        return city_list
+
+    def distance(self, query):
+        return {'distance_nm': calc_distance_new(self.city_list(query))}
+
+    def cost(self, query):
+        record = {'flight_path': ', '.join(self.city_list(query)),
+                  'passengers': query.get('passengers', 0)}
+        cost = calc_cost(record)
+        income = calc_income(record)
+        return {'cost': cost, 'income': income, 'profit': income - cost}
+
+    def reorder(self, query):
+        city_list = rearrange_cities_for_shortest_path(self.city_list(query))
+        return {'path': ', '.join(city_list), 'distance_nm': calc_distance_new(city_list)}
+
+    def replacement(self, query):
+        """Same metric as calc_cumulative_distance_metric(), computed for
+        all profitable flights at once from the distance matrix."""
+        if 'flight_number' in query:
+            dead_record = self.eliminated_by_number.get(str(query['flight_number']))
+            if dead_record is None:
+                raise ValueError(f"flight {query['flight_number']} was not eliminated")
+            eliminated_cities = flight_path2city_list(dead_record['flight_path'])
+        else:
+            eliminated_cities = self.city_list(query)
+        if not self.profitable:
+            raise ValueError('there are no profitable flights')
+        elim = [self.code2index[city] for city in eliminated_cities]
+        # distances from each eliminated city to each candidate's cities
+        distances = self.distance_matrix[elim][:, self.candidate_cities]
+        distances = np.where(self.candidate_mask, distances, np.inf)
+        metric = distances.min(axis=2).sum(axis=0)
+        best = int(np.argmin(metric))
+        record = self.profitable[best]
+        return {'flight_number': record['flight_number'],
+                'flight_path': record['flight_path'],
+                'metric': float(metric[best])}
+
+    # queries that may take a while go to a worker thread
+    slow_ops = {'reorder', 'replacement'}
+
+    async def answer(self, op, query):
+        """Answers one query, going through the cache."""
+        handler = {'distance': self.distance, 'cost': self.cost,
+                   'reorder': self.reorder, 'replacement': self.replacement}.get(op)
+        if handler is None:
+            raise ValueError(f'unknown query {op}')
+        self.n_queries += 1
+        key = (op, json.dumps(query, sort_keys=True))
+        if key in self.cache:
+            self.n_cache_hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key in self.in_flight:
+            self.n_cache_hits += 1
+            return await asyncio.shield(self.in_flight[key])
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            if op in self.slow_ops:
+                result = await asyncio.to_thread(handler, query)
+            else:
+                result = handler(query)
+        except Exception as e:
+            future.set_exception(e)
+            # mark it retrieved, in case nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+        future.set_result(result)
+        self.cache[key] = result
+        if len(self.cache) > cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    async def batch(self, query):
+        """Answers a list of queries concurrently."""
+        async def one(q):
+            # one bad query must not take the whole batch down
+            try:
+                q = dict(q)
+                op = q.pop('op')
+                return await self.answer(op, q)
+            except Exception as e:
+                return {'error': error_message(e)}
+        return {'results': await asyncio.gather(*[one(q) for q in query['queries']])}
+
+    def stats(self):
+        return {'queries': self.n_queries, 'cache_hits': self.n_cache_hits,
+                'cached': len(self.cache), 'profitable': len(self.profitable),
+                'eliminated': len(self.eliminated)}
+
+    async def handle_request(self, method, target, body):
+        """Returns (status, response dictionary) for one HTTP request."""
+        op = target.strip('/')
+        if method == 'GET' and op == 'stats':
+            return 200, self.stats()
+        if method != 'POST':
+            return 405, {'error': 'queries must be POSTed'}
+        try:
+            query = json.loads(body or b'{}')
+            if op == 'batch':
+                return 200, await self.batch(query)
+            return 200, await self.answer(op, query)
+        except json.JSONDecodeError as e:
+            return 400, {'error': f'bad JSON: {e}'}
+        except (KeyError, ValueError, TypeError) as e:
+            return 400, {'error': error_message(e)}
+        except Exception as e:
+            # answer anyway rather than drop the connection
+            return 500, {'error': f'internal error: {e!r}'}
+
+    @staticmethod
+    async def read_request_head(reader, request_line):
+        """Parses the request line and the headers; returns the method,
+        the target, the headers and the length of the body.  Raises
+        ValueError if they are malformed (or too long for the reader)."""
+        parts = request_line.decode().split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise ValueError(f'malformed request line {request_line.strip()[:100]!r}')
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, colon, value = line.decode().partition(':')
+            if not colon:
+                raise ValueError(f'malformed header {line.strip()[:100]!r}')
+            headers[name.strip().lower()] = value.strip()
+        content_length = headers.get('content-length', '0')
+        if not content_length.isdigit():
+            raise ValueError(f'bad Content-Length {content_length[:100]!r}')
+        return method, target, headers, int(content_length)
+
+    @staticmethod
+    async def write_response(writer, status, response):
+        payload = json.dumps(response).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\n'
+                     f'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        """Serves HTTP/1.1 requests on one connection until the client
+        closes it.  A request we can't parse gets a 400 answer, and the
+        connection is closed since we can't tell where the next request
+        would start."""
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                    if not request_line.strip():
+                        break
+                    method, target, headers, content_length = await self.read_request_head(
+                        reader, request_line)
+                except ValueError as e:
+                    await self.write_response(writer, 400, {'error': f'bad request: {e}'})
+                    break
+                body = await reader.readexactly(content_length)
+                status, response = await self.handle_request(method, target, body)
+                await self.write_response(writer, status, response)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service, port):
+    server = await asyncio.start_server(service.handle_connection, '127.0.0.1', port)
+    print(f'# serving flight queries on http://127.0.0.1:{port}/')
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local HTTP/JSON service for route queries.')
+    parser.add_argument('flights_fname', nargs='?', default='sorted_flights_new.txt',
+                        help='newstyle flight file to load')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on (localhost only)')
+    args = parser.parse_args()
+    service = FlightService(args.flights_fname)
+    try:
+        asyncio.run(serve(service, args.port))
+    except KeyboardInterrupt:
+        print('# stats:', service.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,16 @@
 import pprint
 from math import radians, sin, cos, sqrt, atan2
 import itertools
+import math
+import gzip
+import lzma
+import os
+import pickle
+import sys
+import contextlib
+import numpy as np
+
+from memory_profile import memory_budget
 
 # Airport data with latitude and longitude
 airports = {
@@ -16,16 +26,48 @@ airports = {
     'MCI': {'lat': 39.2978, 'lon': -94.7139},
 }
 
-def rearrange_cities_for_shortest_path(city_list):
+# Aircraft we can fly: average speed in knots, operating cost per hour
+# of flight, and number of seats
+aircraft_types = {
+    '737MAX': {'speed_knots': 485, 'cost_per_hour': 5757, 'seats': 204},
+    'A320neo': {'speed_knots': 470, 'cost_per_hour': 5480, 'seats': 180},
+    'E175': {'speed_knots': 430, 'cost_per_hour': 3630, 'seats': 76},
+}
+default_aircraft = '737MAX'     # Boeing 737 MAX
+seat_capacity = aircraft_types[default_aircraft]['seats']
+layover_time_per_stop = 1.5     # hours, from typical averages
+layover_cost_per_hour = 150     # maintenance cost per hour of layover
+avg_ticket_price = 384.85       # ticket price from Bureau of Transportation
+
+def record_fare(record):
+    """The ticket price of a flight: its fare (as set by
+    fare_optimizer.py) if it has one, otherwise the average."""
+    return float(record.get('fare', avg_ticket_price))
+
+def rearrange_cities_for_shortest_path(city_list, fixed_destination=False):
     """Takes a list of cities, and rearranges them so that the path
     between them is shortest.  The first city has to be the same, the
-    others are reordered to make the total distance the least."""
+    others are reordered to make the total distance the least.  If
+    fixed_destination is True the last city also stays put."""
     if len(city_list) == 2:
         return city_list
     c0 = city_list[0]
     # make all possible rearranged flight orders for the other cities
     print('ORIG:', city_list)
-    permuted_other_cities = list(itertools.permutations(city_list[1:]))
+    if fixed_destination:
+        permuted_other_cities = (list(p) + [city_list[-1]]
+                                 for p in itertools.permutations(city_list[1:-1]))
+        n_orders = math.factorial(len(city_list) - 2)
+    else:
+        permuted_other_cities = itertools.permutations(city_list[1:])
+        n_orders = math.factorial(len(city_list) - 1)
+    if not memory_budget.fits(n_orders * bytes_per_candidate_path(len(city_list))):
+        # too many orders to list them all: keep the shortest so far
+        # (min() gives the first of equals, like the stable sort)
+        optimal_city_list = min(([c0] + list(p) for p in permuted_other_cities),
+                                key=calc_distance_new)
+        print('OPTIMAL:', optimal_city_list)
+        return optimal_city_list
     cities_and_length_list = []
     for candidate_path in permuted_other_cities:
         total_candidate_path = [c0] + list(candidate_path)
@@ -38,7 +80,71 @@ def rearrange_cities_for_shortest_path(city_list):
     optimal_city_list = cities_and_length_list[0][0]
     print('OPTIMAL:', optimal_city_list)
     return optimal_city_list
-        
+
+
+def bytes_per_candidate_path(n_cities):
+    """Rough memory of one entry of the candidate list in
+    rearrange_cities_for_shortest_path(): the city list, its length and
+    the pair holding them."""
+    return 200 + 16 * n_cities
+
+
+class StopOrderMemo:
+    """Remembers the optimal stop ordering for each canonical route, so
+    that flights which visit the same airports in a different order
+    only get solved once.  The key is (origin, frozenset of the other
+    airports, fixed_destination) -- and also the destination itself
+    when it is fixed -- and the value is the optimal city list and its
+    length.  The table can be saved to (and loaded from) a pickle
+    file so it carries over between runs."""
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+        if fname is not None and os.path.exists(fname):
+            with open(fname, 'rb') as fp:
+                self.table = pickle.load(fp)
+
+    def canonical_key(self, city_list, fixed_destination=False):
+        if fixed_destination:
+            return (city_list[0], frozenset(city_list[1:-1]), True, city_list[-1])
+        return (city_list[0], frozenset(city_list[1:]), False)
+
+    def shortest_path(self, city_list, fixed_destination=False):
+        """Same as rearrange_cities_for_shortest_path(), but returns the
+        pair (optimal_city_list, length) and looks it up in the table
+        first."""
+        if len(set(city_list)) != len(city_list):
+            # a repeated airport would be lost in the frozenset, so we
+            # don't memoize these
+            optimal = rearrange_cities_for_shortest_path(city_list, fixed_destination)
+            return optimal, calc_distance_new(optimal)
+        key = self.canonical_key(city_list, fixed_destination)
+        if key in self.table:
+            self.hits += 1
+            optimal, length = self.table[key]
+            return list(optimal), length
+        self.misses += 1
+        optimal = rearrange_cities_for_shortest_path(city_list, fixed_destination)
+        length = calc_distance_new(optimal)
+        self.table[key] = (tuple(optimal), length)
+        return list(optimal), length
+
+    def save(self, fname=None):
+        fname = fname or self.fname
+        with open(fname, 'wb') as fp:
+            pickle.dump(self.table, fp)
+
+    def hit_rate(self):
+        n_lookups = self.hits + self.misses
+        return self.hits / n_lookups if n_lookups > 0 else 0.0
+
+    def report(self):
+        print(f'# stop order memo: {self.hits} hits, {self.misses} misses'
+              f' ({100 * self.hit_rate():.1f}% hit rate), {len(self.table)} routes stored')
+
 def flight_path2city_list(flight_path_str):
     """Takes a string with a flight path (example: "DEN, ABQ, LAX, JFK")
     and returns the list of cities (in this case ["DEN", "ABQ", "LAX",
@@ -77,33 +183,126 @@ def haversine_distance_nm(lat1, lon1, lat2, lon2): # AOI
     return distance_nm
 
 
+def haversine_distance_array_nm(lat1, lon1, lat2, lon2):
+    """Vectorized version of haversine_distance_nm(): the arguments are
+    arrays (in degrees) that broadcast against each other."""
+    R = 3440.065  # Radius of Earth in nautical miles
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+
+def haversine_distance_matrix_nm(lats, lons):
+    """Takes arrays of latitudes and longitudes (in degrees) and returns
+    the matrix of distances (in nautical miles) between every pair of
+    points."""
+    lat = np.asarray(lats, dtype=float)
+    lon = np.asarray(lons, dtype=float)
+    return haversine_distance_array_nm(lat[:, None], lon[:, None],
+                                       lat[None, :], lon[None, :])
+
+
+def load_airport_table(fname='airports.txt'):
+    """Reads airports.txt (lines of "code, name, population, lon, lat")
+    and returns a dictionary keyed by airport code, with the same 'lat'
+    and 'lon' entries as the airports dictionary plus 'name' and
+    'population'."""
+    airport_table = {}
+    with open(fname, 'r') as fp:
+        for line in fp:
+            parts = [part.strip() for part in line.split(',')]
+            if len(parts) != 5:
+                continue
+            code, name, population, lon, lat = parts
+            airport_table[code] = {'lat': float(lat), 'lon': float(lon),
+                                   'name': name,
+                                   'population': int(population)}
+    return airport_table
+
+
 def calculate_flight_time(lon1, lat1, lon2, lat2):
     """Calculate flight time and operational cost."""
     if None in [lat1, lon1, lat2, lon2]:
         return 0, 0  # Handle invalid coordinates
     distance_nm = haversine_distance_nm(lat1, lon1, lat2, lon2)
-    speed_knots = 485  # Average speed of a Boeing 737 MAX in knots
-    flight_time = distance_nm / speed_knots
-    operational_cost = 5757 * flight_time
+    aircraft = aircraft_types[default_aircraft]
+    flight_time = distance_nm / aircraft['speed_knots']
+    operational_cost = aircraft['cost_per_hour'] * flight_time
     return flight_time, operational_cost
 
+# the stdout that records written to '-' go to, while
+# diagnostics_to_stderr() has print() going to stderr
+_records_stdout = None
+
+
+def records_stdout():
+    return _records_stdout or sys.stdout
+
+
+@contextlib.contextmanager
+def diagnostics_to_stderr(fname):
+    """When fname is '-', so that the stage writes its records to
+    stdout, sends everything else it prints to stderr meanwhile --
+    otherwise the next stage of the pipeline would read it as flights."""
+    global _records_stdout
+    if fname != '-':
+        yield
+        return
+    _records_stdout = sys.stdout
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            yield
+    finally:
+        _records_stdout = None
+
+
+def open_flight_file(fname, mode='r', compress_as=None):
+    """Opens a flight file in text mode, transparently compressing or
+    decompressing it if the name (or compress_as, if given) ends in .gz
+    or .xz.  The name '-' stands for stdin (or stdout, for writing),
+    which is left open when the file is closed."""
+    if fname == '-':
+        return contextlib.nullcontext(sys.stdin if mode == 'r' else records_stdout())
+    compress_as = compress_as or fname
+    if compress_as.endswith('.gz'):
+        return gzip.open(fname, mode + 't')
+    if compress_as.endswith('.xz'):
+        return lzma.open(fname, mode + 't')
+    return open(fname, mode, buffering=1024 * 1024)
+
+
+def iter_flights_newstyle(fname):
+    """Generator version of load_flights_newstyle(): reads the file a
+    line at a time and yields one record dictionary at a time, so only
+    one record is in memory."""
+    with open_flight_file(fname, 'r') as fp:
+        yield from iter_records_newstyle(fp)
+
+
+def iter_records_newstyle(lines):
+    """Yields the records of newstyle text given as any iterable of
+    lines (an open file, stdin...), each one as soon as its last line
+    has been read."""
+    # break it into records separated by
+    # __FLIGHT_RECORD_SEPARATOR__
+    record_lines = []
+    for line in lines:
+        if line.strip() == '__FLIGHT_RECORD_SEPARATOR__':
+            yield parse_record(''.join(record_lines))
+            record_lines = []
+        else:
+            record_lines.append(line)
+    if ''.join(record_lines).strip():
+        yield parse_record(''.join(record_lines))
+
+
 def load_flights_newstyle(fname):
     """Loads flights from a flight path file, and returns a dictionary
     with all the info."""
-    all_flights = []
-    with open(fname, 'r') as fp:
-        # first break it into records separated by
-        # __FLIGHT_RECORD_SEPARATOR__
-        all_txt = fp.read()
-        record_strings = all_txt.split('__FLIGHT_RECORD_SEPARATOR__')
-        for record in record_strings:
-            record_dict = parse_record(record)
-            # now append to the overall list
-            all_flights.append(record_dict)
-            # # special: use the flight_number as the key into the
-            # # overall dictionary of *all* flights
-            # all_flights[record_dict['flight_number']] = record_dict
-    return all_flights
+    return list(iter_flights_newstyle(fname))
 
 
 def parse_record(record_str):
@@ -121,60 +320,128 @@ def parse_record(record_str):
     return result
 
 
+def format_newstyle_route(newstyle_route):
+    """Returns the "key: value" lines of a newstyle route as one
+    string."""
+    return ''.join(f"{key}: {value}\n" for key, value in newstyle_route.items())
+
+
 def append_newstyle_route(fp, newstyle_route):
     """Takes a file object already open for writing and appends a route to
     it."""
-    # print('ABOUT:', newstyle_route)
-    for key in newstyle_route:
-        # print(key, newstyle_route[key])
-        fp.write(f"{key}: {newstyle_route[key]}\n")
+    fp.write(format_newstyle_route(newstyle_route))
+
+
+class FlightFileWriter:
+    """Streams routes to a file one at a time.  Each route is turned into
+    text by format_record and the text is collected in a buffer which is
+    written out in one go every buffer_records routes, so we never hold
+    more than that many routes in memory.  The separator goes between
+    records (not after the last one).
+
+    The records go to a temporary file next to fname, which is renamed
+    to fname only when the writer is closed without an error -- so a
+    crash never leaves a truncated file for the next stage to read.  A
+    fname ending in .gz or .xz is compressed.
+
+    A fname of '-' writes to stdout instead, one record at a time so
+    that the next stage of a shell pipeline gets them as they come
+    (stdout's own buffer still groups them into large writes).  There
+    is no temporary file then: the reading stage sees a truncated
+    stream as an error of this one."""
+
+    def __init__(self, fname, format_record=format_newstyle_route,
+                 separator='__FLIGHT_RECORD_SEPARATOR__\n',
+                 buffer_records=10000):
+        self.fname = fname
+        self.format_record = format_record
+        self.separator = separator
+        self.buffer_records = buffer_records
+        self.n_written = 0
+        self.buffer = []
+        if fname == '-':
+            self.buffer_records = 1
+            self.tmp_fname = None
+            self.fp = records_stdout()
+        else:
+            self.tmp_fname = f'{fname}.{os.getpid()}.tmp'
+            self.fp = open_flight_file(self.tmp_fname, 'w', compress_as=fname)
+
+    def write(self, route):
+        if self.n_written > 0:
+            self.buffer.append(self.separator)
+        self.buffer.append(self.format_record(route))
+        self.n_written += 1
+        if self.n_written % self.buffer_records == 0:
+            self.flush()
+
+    def flush(self):
+        self.fp.write(''.join(self.buffer))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self.tmp_fname is None:
+            # stdout stays open for whoever else writes to it
+            self.fp.flush()
+            return
+        self.fp.close()
+        os.replace(self.tmp_fname, self.fname)
+
+    def abort(self):
+        """Throws away everything written so far; fname is untouched."""
+        if self.tmp_fname is None:
+            # what went to stdout can't be taken back
+            self.buffer = []
+            return
+        self.fp.close()
+        os.remove(self.tmp_fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
 
 
 def write_flights_newstyle(fname, newstyle_all_routes):
     """Takes a list of routes (newstyle) a simple file with record
     separators and each record having "key: value" lines."""
-    with open(fname, 'w') as fp:
-        for order_no, route in enumerate(newstyle_all_routes):
+    with FlightFileWriter(fname) as writer:
+        for route in newstyle_all_routes:
             # pprint.pprint(route)
             # print('WRITING_NEWSTYLE:', route['flight_number'])
-            append_newstyle_route(fp, route)
-            # don't put record separator for the last one
-            if order_no != len(newstyle_all_routes) - 1:
-                fp.write('__FLIGHT_RECORD_SEPARATOR__\n')
+            writer.write(route)
     print('# wrote newstyle routes to file', fname)
 
 
 def write_flights_oldstyle2newstyle(fname, oldstyle_all_routes):
     """Takes the rather elaborate routes dictionary and writes a simple
     file with just the essential entries."""
-    with open(fname, 'w') as fp:
-        for order_no, oldstyle_route in enumerate(oldstyle_all_routes):
+    with FlightFileWriter(fname, format_oldstyle_route2newstyle) as writer:
+        for oldstyle_route in oldstyle_all_routes:
             print('ANOTHER_OLDSTYLE_WRITING:', oldstyle_route['Route'])
-            newstyle_dict = {}
-            newstyle_dict['flight_number'] = oldstyle_route['Route']
-            newstyle_dict['origin'] = oldstyle_route['Origin']
-            newstyle_dict['destination'] = oldstyle_route['Destination']
-            newstyle_dict['passengers'] = oldstyle_route['Passengers']
-            newstyle_dict['flight_path'] = (oldstyle_route['Origin']
-                                            + ", " + oldstyle_route['Stop1']
-                                            + ", " + oldstyle_route['Stop2']
-                                            + ", " + oldstyle_route['Destination'])
-            newstyle_dict['n_stops'] = oldstyle_route['Stops']
-            append_newstyle_route(fp, newstyle_dict)
-            # don't do it for the last one
-            if order_no != len(oldstyle_all_routes) - 1:
-                fp.write('__FLIGHT_RECORD_SEPARATOR__\n')
+            writer.write(oldstyle_route)
     print('# wrote newstyle routes to file', fname)
 
 
+def format_oldstyle_route2newstyle(oldstyle_route):
+    """Formats an oldstyle route as the text of a newstyle record."""
+    return format_newstyle_route(convert_route_oldstyle2newstyle(oldstyle_route,
+                                                                 verbose=False))
+
 
-def convert_route_oldstyle2newstyle(oldstyle_route):
+def convert_route_oldstyle2newstyle(oldstyle_route, verbose=True):
     """Takes the rather elaborate oldstyle route dictionary and returns a
     simpler newstyle one with just the necessary information:
     flight_number, origin, destination, passengers, flight_path, and
     n_stops.
     """
-    print('OLDSTYLE_ROUTE2NEW:', oldstyle_route['Route'])
+    if verbose:
+        print('OLDSTYLE_ROUTE2NEW:', oldstyle_route['Route'])
     newstyle_dict = {}
     newstyle_dict['flight_number'] = oldstyle_route['Route']
     newstyle_dict['origin'] = oldstyle_route['Origin']
@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+
+"""Picks hub airports and proposes hub-and-spoke replacements.
+
+calc_cumulative_distance_metric() in flight_optimization.py adds up,
+for every city, the distance to the closest city of a candidate set.
+Weighting each city by its demand and asking for the set of k hubs
+that makes this sum smallest is the p-median problem:
+
+    minimize  sum_i  w(i) * min_{h in hubs} distance(i, h)
+
+We solve it with a greedy start (add the hub that lowers the objective
+the most, k times) followed by Teitz-Bart style local search: try
+swapping every hub for every other airport and make the best swap
+while it helps.  Both steps are vectorized over the precomputed
+distance matrix, keeping for each airport the distance to its nearest
+and second nearest hub so a swap is evaluated without recomputing
+everything.
+
+With the hubs chosen, every eliminated flight is replaced by a
+hub-and-spoke route: origin -> origin's hub -> destination's hub ->
+destination.
+"""
+
+import argparse
+import numpy as np
+
+from flight_utils import *
+from flight_optimization import prune_unprofitable_flights
+
+
+def p_median_objective(distance_matrix, weights, hubs):
+    return float(weights @ distance_matrix[:, hubs].min(axis=1))
+
+
+def greedy_hubs(distance_matrix, weights, k):
+    """Adds hubs one at a time, each time the one that lowers the
+    objective the most."""
+    n = len(weights)
+    hubs = []
+    nearest = np.full(n, np.inf)
+    for _ in range(k):
+        # objective if each airport j were added: rows are airports i,
+        # columns are candidates j
+        objective = weights @ np.minimum(distance_matrix, nearest[:, None])
+        objective[hubs] = np.inf
+        best = int(np.argmin(objective))
+        hubs.append(best)
+        nearest = np.minimum(nearest, distance_matrix[:, best])
+    return hubs
+
+
+def nearest_two(distance_matrix, hubs):
+    """For every airport, the position (in hubs) of its nearest hub and
+    the distances to the nearest and second nearest hubs."""
+    hub_distances = distance_matrix[:, hubs]
+    order = np.argsort(hub_distances, axis=1)
+    rows = np.arange(len(distance_matrix))
+    d1 = hub_distances[rows, order[:, 0]]
+    d2 = hub_distances[rows, order[:, 1]] if len(hubs) > 1 else np.full(len(rows), np.inf)
+    return order[:, 0], d1, d2
+
+
+def swap_local_search(distance_matrix, weights, hubs, max_iter=1000, tol=1e-9):
+    """Teitz-Bart style improvement: repeatedly makes the single
+    (hub out, airport in) swap that lowers the objective the most,
+    until no swap helps."""
+    hubs = list(hubs)
+    n = len(weights)
+    k = len(hubs)
+    for _ in range(max_iter):
+        nearest, d1, d2 = nearest_two(distance_matrix, hubs)
+        current = float(weights @ d1)
+        # objective after adding candidate j, if no hub were removed
+        with_d1 = np.minimum(distance_matrix, d1[:, None])
+        base = weights @ with_d1
+        # airports whose nearest hub is removed fall back on the second
+        # nearest one; sum that correction per hub
+        with_d2 = np.minimum(distance_matrix, d2[:, None])
+        membership = np.zeros((k, n))
+        membership[nearest, np.arange(n)] = weights
+        objective = base[None, :] + membership @ (with_d2 - with_d1)
+        objective[:, hubs] = np.inf
+        out_pos, best_in = np.unravel_index(np.argmin(objective), objective.shape)
+        if objective[out_pos, best_in] >= current - tol:
+            break
+        hubs[out_pos] = int(best_in)
+    return hubs
+
+
+def select_hubs(distance_matrix, weights, k):
+    """Greedy start followed by swap local search; returns the hub
+    indices and the objective.  k must be between 1 and the number of
+    airports."""
+    distance_matrix = np.asarray(distance_matrix, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    if not 1 <= k <= len(weights):
+        raise ValueError(f'*error* k must be between 1 and {len(weights)} (the number of airports), not {k}')
+    hubs = swap_local_search(distance_matrix, weights,
+                             greedy_hubs(distance_matrix, weights, k))
+    return hubs, p_median_objective(distance_matrix, weights, hubs)
+
+
+def hub_and_spoke_path(origin, destination, hub_of):
+    """origin -> hub -> hub -> destination, without repeating a city."""
+    city_list = []
+    for city in [origin, hub_of[origin], hub_of[destination], destination]:
+        if not city_list or city_list[-1] != city:
+            city_list.append(city)
+    return city_list
+
+
+def propose_hub_routes(eliminated, hub_codes):
+    """Newstyle records of hub-and-spoke routes replacing the eliminated
+    flights; each keeps the flight_number and passengers of the flight
+    it replaces."""
+    hub_of = {code: min(hub_codes, key=lambda hub: city2city_distance(code, hub))
+              for code in airports}
+    routes = []
+    for dead_record in eliminated:
+        city_list = flight_path2city_list(dead_record['flight_path'])
+        new_city_list = hub_and_spoke_path(city_list[0], city_list[-1], hub_of)
+        routes.append({'flight_number': dead_record['flight_number'],
+                       'origin': new_city_list[0],
+                       'destination': new_city_list[-1],
+                       'passengers': dead_record['passengers'],
+                       'flight_path': ', '.join(new_city_list),
+                       'n_stops': len(new_city_list) - 2})
+    return routes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Choose k hubs (p-median) and propose hub-and-spoke replacement routes.')
+    parser.add_argument('sorted_fname', nargs='?', default='sorted_flights_new.txt',
+                        help='newstyle flight file to prune and replace')
+    parser.add_argument('--k', type=int, default=3, help='number of hubs')
+    parser.add_argument('--out', default='hub_replacement_flights.txt',
+                        help='file in which to write the proposed routes')
+    args = parser.parse_args()
+
+    airport_table = load_airport_table()
+    codes = list(airports.keys())
+    if not 1 <= args.k <= len(codes):
+        parser.error(f'--k must be between 1 and {len(codes)} (the number of airports)')
+    distance_matrix = haversine_distance_matrix_nm([airports[c]['lat'] for c in codes],
+                                                   [airports[c]['lon'] for c in codes])
+    weights = [airport_table[c]['population'] for c in codes]
+    hubs, objective = select_hubs(distance_matrix, weights, args.k)
+    hub_codes = [codes[h] for h in hubs]
+    print(f'# hubs: {", ".join(hub_codes)}')
+    print(f'# population-weighted distance to nearest hub: {objective:.0f}')
+
+    all_flights = load_flights_newstyle(args.sorted_fname)
+    _, eliminated = prune_unprofitable_flights(all_flights)
+    routes = propose_hub_routes(eliminated, hub_codes)
+    for dead_record, route in zip(eliminated, routes):
+        print(f"HUB_REPLACEMENT: Flight {dead_record['flight_number']}:"
+              f" {dead_record['flight_path']} -> {route['flight_path']}")
+    write_flights_newstyle(args.out, routes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#! /usr/bin/env python3
+
+"""Itineraries for the passengers of eliminated flights.
+
+find_closest_match() sends the passengers of an eliminated flight to
+the profitable flight that looks most like it, even if that flight
+doesn't actually go from their origin to their destination.  Here we
+look for real itineraries instead, on a one-day timetable of the
+profitable flights.
+
+Every leg of every profitable flight becomes a connection (from, to,
+departure, arrival, flight), timed like fleet_scheduler.py does it:
+flight times from calculate_flight_time() and a layover at each
+intermediate stop.  The connections are sorted by departure once, and
+the Connection Scan Algorithm finds the earliest arrival for a query
+in a single pass over them: a flight can be boarded at a stop if we
+are there in time (plus the minimum connection time, when we came in
+on another flight), and once boarded we stay on it for free.
+Earliest arrivals are kept separately for each number of flights
+taken, so the number of transfers is bounded.
+
+A scan from one origin gives the earliest arrival at every airport,
+so queries that leave the same origin at the same time share one
+scan.  The scan is vectorized over these sources: each connection
+updates the state of a whole block of them at once.  The block is
+sized so that its per-trip state stays within max_scan_bytes, a
+connection that nobody in the block can have reached is skipped with
+a scalar test, and the scan stops as soon as connections depart after
+the arrival already found at every wanted destination.
+"""
+
+import argparse
+import random
+import numpy as np
+
+from flight_utils import *
+from flight_optimization import prune_unprofitable_flights
+from fleet_scheduler import departure_time
+
+min_connection_time = 1.0       # hours needed to change flights
+max_transfers = 2
+query_block = 4096              # most sources scanned together
+max_scan_bytes = 256 << 20      # state of the sources scanned together
+check_every = 64                # connections between tests for stopping early
+
+
+class Timetable:
+    """The connection array: parallel arrays sorted by departure."""
+
+    def __init__(self, flights, seed=None):
+        rng = random.Random(seed)
+        self.airport_codes = list(airports.keys())
+        self.code2index = {code: i for i, code in enumerate(self.airport_codes)}
+        self.flight_numbers = []
+        connections = []
+        for trip, record in enumerate(flights):
+            self.flight_numbers.append(record['flight_number'])
+            city_list = flight_path2city_list(record['flight_path'])
+            time = departure_time(record, rng)
+            for leg_no, (c1, c2) in enumerate(zip(city_list[:-1], city_list[1:])):
+                if leg_no > 0:
+                    time += layover_time_per_stop
+                flight_time, _ = calculate_flight_time(airports[c1]['lon'], airports[c1]['lat'],
+                                                       airports[c2]['lon'], airports[c2]['lat'])
+                connections.append((time, time + flight_time,
+                                    self.code2index[c1], self.code2index[c2], trip))
+                time += flight_time
+        connections.sort()
+        self.dep_time = np.array([c[0] for c in connections])
+        self.arr_time = np.array([c[1] for c in connections])
+        self.dep_stop = np.array([c[2] for c in connections], dtype=np.int64)
+        self.arr_stop = np.array([c[3] for c in connections], dtype=np.int64)
+        self.trip = np.array([c[4] for c in connections], dtype=np.int64)
+        self.n_trips = len(self.flight_numbers)
+
+    def block_size(self, max_transfers=max_transfers):
+        """How many sources scan() can take at once within
+        max_scan_bytes: each one has two int64 entries per trip and four
+        8-byte entries per level and stop."""
+        n_levels = max_transfers + 2
+        bytes_per_source = 16 * self.n_trips + 32 * n_levels * len(self.airport_codes)
+        return max(1, min(query_block, max_scan_bytes // bytes_per_source))
+
+    def scan(self, origins, start_times, targets=None, max_transfers=max_transfers):
+        """Connection Scan for a block of sources (arrays of airport
+        indices and start times) to every airport.  targets, if given,
+        is a list with an array of the wanted destinations of each
+        source: the scan stops once none of their arrivals can still
+        improve.  Returns the state read by arrival() and journey()."""
+        n_sources = len(origins)
+        n_stops = len(self.airport_codes)
+        n_levels = max_transfers + 2    # 0 .. max_transfers+1 flights taken
+        sources = np.arange(n_sources)
+        # earliest[s, v, q]: earliest arrival of source q at stop s with
+        # at most v flights
+        earliest = np.full((n_stops, n_levels, n_sources), np.inf)
+        earliest[origins, 0, sources] = start_times
+        # how we got there: the connections we got on and off at, and
+        # the number of flights taken when we got on
+        in_connection = np.full((n_stops, n_levels, n_sources), -1, dtype=np.int64)
+        in_boarding = np.full((n_stops, n_levels, n_sources), -1, dtype=np.int64)
+        in_level = np.zeros((n_stops, n_levels, n_sources), dtype=np.int64)
+        # fewest flights with which each trip has been boarded, and where
+        trip_level = np.full((self.n_trips, n_sources), n_levels, dtype=np.int64)
+        trip_boarding = np.full((self.n_trips, n_sources), -1, dtype=np.int64)
+        # scalar bounds for skipping connections: the earliest time any
+        # source is at each stop, and the trips anyone has boarded
+        first_reached = [np.inf] * n_stops
+        for stop, time in zip(origins.tolist(), start_times.tolist()):
+            first_reached[stop] = min(first_reached[stop], time)
+        trip_boarded = [False] * self.n_trips
+        if targets is not None:
+            target_stops = np.concatenate(targets)
+            target_sources = np.repeat(sources, [len(t) for t in targets])
+        levels = np.arange(n_levels)[:, None]
+        dep_times = self.dep_time.tolist()
+        arr_times = self.arr_time.tolist()
+        dep_stops = self.dep_stop.tolist()
+        arr_stops = self.arr_stop.tolist()
+        trips = self.trip.tolist()
+        first = int(np.searchsorted(self.dep_time, start_times.min()))
+        for c in range(first, len(dep_times)):
+            dep_time = dep_times[c]
+            trip = trips[c]
+            if targets is not None and (c - first) % check_every == 0:
+                # later connections arrive later than dep_time
+                if dep_time >= earliest[target_stops, -1, target_sources].max():
+                    break
+            if not trip_boarded[trip] and first_reached[dep_stops[c]] > dep_time:
+                continue
+            # can we board here, and with how many flights behind us?
+            ready = earliest[dep_stops[c], :-1].copy()
+            ready[1:] += min_connection_time
+            can_board = ready <= dep_time
+            board_level = np.where(can_board.any(axis=0), can_board.argmax(axis=0) + 1, n_levels)
+            on_level = trip_level[trip]
+            improved = board_level < on_level
+            if improved.any():
+                on_level[improved] = board_level[improved]
+                trip_boarding[trip][improved] = c
+                trip_boarded[trip] = True
+            elif not trip_boarded[trip]:
+                continue
+            # everyone on the trip can get off here
+            arr_stop = arr_stops[c]
+            arr_time = arr_times[c]
+            on_trip = levels >= on_level[None, :]
+            better = on_trip & (arr_time < earliest[arr_stop])
+            if not better.any():
+                continue
+            earliest[arr_stop][better] = arr_time
+            in_connection[arr_stop][better] = c
+            in_boarding[arr_stop][better] = np.broadcast_to(trip_boarding[trip], better.shape)[better]
+            in_level[arr_stop][better] = np.broadcast_to(on_level, better.shape)[better]
+            first_reached[arr_stop] = min(first_reached[arr_stop], arr_time)
+        return earliest, in_connection, in_boarding, in_level
+
+    @staticmethod
+    def arrival(state, q, destination):
+        """Source q's earliest arrival at destination (inf if
+        unreachable) and the fewest flights that give it (-1 if
+        unreachable)."""
+        earliest = state[0][destination, :, q]
+        best = earliest[-1]
+        if not np.isfinite(best):
+            return best, -1
+        return best, int((earliest == best).argmax())
+
+    def journey(self, state, q, destination, n_flights):
+        """Walks back from the destination to give the legs of source
+        q's itinerary, as (flight_number, from, to, departure, arrival)."""
+        _, in_connection, in_boarding, in_level = state
+        legs = []
+        stop = destination
+        level = n_flights
+        while level > 0:
+            c_off = in_connection[stop, level, q]
+            c_on = in_boarding[stop, level, q]
+            legs.append((self.flight_numbers[self.trip[c_off]],
+                         self.airport_codes[self.dep_stop[c_on]],
+                         self.airport_codes[self.arr_stop[c_off]],
+                         float(self.dep_time[c_on]), float(self.arr_time[c_off])))
+            level = in_level[stop, level, q] - 1
+            stop = self.dep_stop[c_on]
+        return legs[::-1]
+
+
+def search_itineraries(timetable, od_pairs, start_time=0.0):
+    """Earliest-arrival itineraries for a list of (origin, destination)
+    airport codes, all leaving no earlier than start_time.  Returns a
+    list of (arrival, legs) with arrival None when there's no way to
+    get there within the transfer limit."""
+    # one scan per origin, for all the destinations wanted from it
+    wanted = {}
+    for origin, destination in od_pairs:
+        wanted.setdefault(timetable.code2index[origin], set()).add(timetable.code2index[destination])
+    found = {}
+    origin_list = list(wanted)
+    block_size = timetable.block_size()
+    for start in range(0, len(origin_list), block_size):
+        block = origin_list[start:start + block_size]
+        targets = [np.array(sorted(wanted[origin]), dtype=np.int64) for origin in block]
+        state = timetable.scan(np.array(block, dtype=np.int64),
+                               np.full(len(block), float(start_time)), targets)
+        for q, origin in enumerate(block):
+            for destination in targets[q].tolist():
+                best, n_flights = timetable.arrival(state, q, destination)
+                if np.isfinite(best):
+                    legs = timetable.journey(state, q, destination, n_flights)
+                    found[origin, destination] = (float(best), legs)
+                else:
+                    found[origin, destination] = (None, [])
+    return [found[timetable.code2index[origin], timetable.code2index[destination]]
+            for origin, destination in od_pairs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find itineraries for the passengers of eliminated flights.')
+    parser.add_argument('sorted_fname', nargs='?', default='sorted_flights_new.txt',
+                        help='newstyle flight file to prune')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for the departure times')
+    parser.add_argument('--out', default='itineraries.txt',
+                        help='file in which to write the itineraries')
+    args = parser.parse_args()
+
+    all_flights = load_flights_newstyle(args.sorted_fname)
+    profitable, eliminated = prune_unprofitable_flights(all_flights)
+    timetable = Timetable(profitable, seed=args.seed)
+    od_pairs = [(record['origin'], record['destination']) for record in eliminated]
+    results = search_itineraries(timetable, od_pairs)
+    n_found = 0
+    with open(args.out, 'w') as fp:
+        for record, (arrival, legs) in zip(eliminated, results):
+            if arrival is None:
+                line = f"Flight {record['flight_number']}: {record['origin']} -> {record['destination']}: no itinerary"
+            else:
+                n_found += 1
+                legs_str = ', '.join(f'{flight_number} {c1}-{c2} {dep:.2f}-{arr:.2f}'
+                                     for flight_number, c1, c2, dep, arr in legs)
+                line = (f"Flight {record['flight_number']}: {record['origin']} -> {record['destination']}:"
+                        f" arrive {arrival:.2f}, {len(legs) - 1} transfers: {legs_str}")
+            print('ITINERARY:', line)
+            fp.write(line + '\n')
+    print(f'# found itineraries for {n_found} of {len(eliminated)} eliminated flights')
+    print('# wrote itineraries to file', args.out)
+
+
+if __name__ == '__main__':
+    main()
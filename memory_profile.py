@@ -0,0 +1,196 @@
+"""Peak-memory profiling and a memory budget for the pipeline stages.
+
+With --profile-memory a script runs under tracemalloc, and each step of
+the stage (loading, reordering, writing...) is measured on its own:
+its peak traced memory and the source lines whose allocations grew
+the most during the step.  The report shows which structure is to blame
+when a run grows too big.
+
+With --memory-budget SIZE (or the FLIGHT_MEMORY_BUDGET environment
+variable) a stage checks, before building a big in-memory structure,
+whether it fits in what is left of the budget.  If it doesn't, the
+stage switches to its streaming or chunked path when it has one, and
+otherwise stops with a MemoryBudgetExceeded error saying what didn't
+fit -- rather than letting the machine swap or the process be killed.
+"""
+
+import contextlib
+import os
+import sys
+import tracemalloc
+
+# memory of parsed records per byte of flight file, measured with
+# tracemalloc on load_flights_newstyle()
+parsed_bytes_per_file_byte = 7
+# size ratio assumed for compressed flight files
+compression_ratio = {'.gz': 5, '.xz': 8}
+size_units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+def parse_size(size_str):
+    """'512M' -> 536870912; the unit (K, M, G or T, optionally followed
+    by B or iB) defaults to bytes, which can also be written B."""
+    text = size_str.strip().upper()
+    if text.endswith('IB') and text[-3:-2] in ('K', 'M', 'G', 'T'):
+        text = text[:-2]
+    elif text.endswith('B'):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in size_units else ''
+    number = text[:-1] if unit else text
+    try:
+        return int(float(number) * size_units[unit])
+    except ValueError:
+        raise ValueError(f'*error* bad memory size {size_str!r} - use e.g. 512M or 2G')
+
+
+def format_size(n_bytes, sign=''):
+    for unit in ('GiB', 'MiB', 'KiB'):
+        scale = size_units[unit[0]]
+        if abs(n_bytes) >= scale:
+            return f'{n_bytes / scale:{sign}.1f} {unit}'
+    return f'{n_bytes:{sign}d} B'
+
+
+def current_memory():
+    """Memory in use now: what tracemalloc has traced if it is running,
+    otherwise the resident set size of the process (or 0 where there is
+    no /proc, so that only the new structure counts)."""
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def flight_file_memory(fname):
+    """Rough size in memory of all the records of a flight file."""
+    n_bytes = os.path.getsize(fname)
+    for suffix, ratio in compression_ratio.items():
+        if fname.endswith(suffix):
+            n_bytes *= ratio
+    return n_bytes * parsed_bytes_per_file_byte
+
+
+class MemoryBudget:
+    """A limit on the memory of the process (None for no limit)."""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+
+    def fits(self, n_bytes):
+        """Whether n_bytes more would still be within the budget."""
+        return self.limit is None or current_memory() + n_bytes <= self.limit
+
+    def available(self):
+        """Bytes left in the budget (None for no limit)."""
+        if self.limit is None:
+            return None
+        return max(self.limit - current_memory(), 0)
+
+    def require(self, n_bytes, what, advice=''):
+        """Raises MemoryBudgetExceeded if n_bytes more would not fit."""
+        if not self.fits(n_bytes):
+            raise MemoryBudgetExceeded(
+                f'*error* {what} needs about {format_size(n_bytes)}, but only'
+                f' {format_size(self.available())} of the {format_size(self.limit)}'
+                f' memory budget is left' + (f' - {advice}' if advice else ''))
+
+
+# the budget checked by the stages; set by set_memory_budget()
+memory_budget = MemoryBudget(parse_size(os.environ['FLIGHT_MEMORY_BUDGET'])
+                             if os.environ.get('FLIGHT_MEMORY_BUDGET') else None)
+
+
+def set_memory_budget(limit):
+    """Sets the budget of every stage in this process; limit is in
+    bytes, or a string such as '512M', or None for no limit."""
+    if isinstance(limit, str):
+        limit = parse_size(limit)
+    memory_budget.limit = limit
+
+
+class MemoryProfiler:
+    """Measures the steps of a stage with tracemalloc.  When not enabled
+    the steps cost nothing."""
+
+    def __init__(self, stage_name, enabled=True, top=5):
+        self.stage_name = stage_name
+        self.enabled = enabled
+        self.top = top
+        self.steps = []
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def step(self, name):
+        if not self.enabled:
+            yield
+            return
+        before = self.snapshot()
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            growth = [stat for stat in self.snapshot().compare_to(before, 'lineno')
+                      if stat.size_diff > 0]
+            self.steps.append((name, start, current, peak, growth[:self.top]))
+
+    @staticmethod
+    def snapshot():
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ])
+
+    def report(self, report=print):
+        if not self.enabled:
+            return
+        report(f'# memory profile of {self.stage_name}:')
+        for name, start, current, peak, top_stats in self.steps:
+            report(f'#   {name}: peak {format_size(peak)},'
+                   f' {format_size(current - start, sign="+")} held afterwards')
+            for stat in top_stats:
+                frame = stat.traceback[0]
+                report(f'#     {format_size(stat.size_diff, sign="+"):>12} in {stat.count_diff:>+9} blocks'
+                       f'  {os.path.basename(frame.filename)}:{frame.lineno}')
+        report(f'#   overall peak {format_size(max((s[3] for s in self.steps), default=0))}')
+
+
+def add_memory_arguments(parser):
+    """The memory options shared by the pipeline scripts."""
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='report the peak memory and top allocation sites of each step')
+    parser.add_argument('--memory-budget', default=None,
+                        help='memory limit in bytes, or with a K, M, G or T unit (optionally'
+                             ' followed by B or iB), such as 100B, 512M, 512MB or 2GiB'
+                             ' (default: $FLIGHT_MEMORY_BUDGET); steps that would exceed it'
+                             ' stream their data or stop early')
+
+
+def setup_memory(args, stage_name):
+    """Applies the memory options; returns the stage's profiler."""
+    if args.memory_budget is not None:
+        set_memory_budget(args.memory_budget)
+    return MemoryProfiler(stage_name, enabled=args.profile_memory)
+
+
+@contextlib.contextmanager
+def exit_on_budget_exceeded():
+    """For the main() of a stage: a MemoryBudgetExceeded ends the
+    script with its message on stderr and exit status 1, rather than
+    a traceback -- the message already says what didn't fit."""
+    try:
+        yield
+    except MemoryBudgetExceeded as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
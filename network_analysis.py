@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+
+"""Hub analytics of a route network.
+
+The legs of every flight in a flight file make a directed graph
+between airports, with each edge weighted by the passengers flown on
+it and its distance.  The graph is kept sparse, as coordinate arrays
+(source, target, weight) with duplicate legs merged, so that it never
+turns into an airports x airports matrix.  From it we compute, with
+array operations only:
+
+  - the degree (number of distinct airports served) of each airport,
+  - its passenger throughput (passengers on legs in and out),
+  - its transit passengers: passengers on flights that stop there
+    without starting or ending there, a betweenness-style measure of
+    how much traffic flows *through* the airport,
+  - a passenger-weighted PageRank hub score,
+  - and the connected components of the network,
+
+and write a report of the airports ranked by hub score.
+"""
+
+import sys
+import numpy as np
+
+from flight_utils import *
+from cost_model import FlightTable
+
+
+class RouteNetwork:
+    """The sparse leg graph of a FlightTable.  Edges are stored as
+    parallel arrays src, dst, passengers, distance_nm (distance of a
+    single leg), n_legs (how many legs were merged into the edge)."""
+
+    def __init__(self, table):
+        self.table = table
+        self.airport_codes = table.airport_codes
+        self.n_airports = len(table.airport_codes)
+        n = self.n_airports
+        leg_passengers = table.passengers[table.leg_flight].astype(float)
+        # merge the legs between the same pair of airports
+        edge_keys, edge_of_leg = np.unique(table.leg_from * n + table.leg_to,
+                                           return_inverse=True)
+        self.src = edge_keys // n
+        self.dst = edge_keys % n
+        self.passengers = np.bincount(edge_of_leg, weights=leg_passengers,
+                                      minlength=len(edge_keys))
+        self.n_legs = np.bincount(edge_of_leg, minlength=len(edge_keys))
+        self.distance_nm = np.zeros(len(edge_keys))
+        self.distance_nm[edge_of_leg] = table.leg_distance_nm
+
+    def degree(self):
+        """Number of distinct airports each airport has legs to or from."""
+        n = self.n_airports
+        pairs = np.unique(np.minimum(self.src, self.dst) * n
+                          + np.maximum(self.src, self.dst))
+        return (np.bincount(pairs // n, minlength=n)
+                + np.bincount(pairs % n, minlength=n))
+
+    def throughput(self):
+        """Passengers on all legs departing from or arriving at each
+        airport."""
+        n = self.n_airports
+        return (np.bincount(self.src, weights=self.passengers, minlength=n)
+                + np.bincount(self.dst, weights=self.passengers, minlength=n))
+
+    def passenger_miles(self):
+        """Passenger miles flown on legs departing from each airport."""
+        return np.bincount(self.src, weights=self.passengers * self.distance_nm,
+                           minlength=self.n_airports)
+
+    def transit_passengers(self):
+        """Passengers on flights that pass through each airport as an
+        intermediate stop."""
+        table = self.table
+        visit_flight = table.visit_flight
+        first = np.ones(len(visit_flight), dtype=bool)
+        first[1:] = visit_flight[1:] != visit_flight[:-1]
+        last = np.ones(len(visit_flight), dtype=bool)
+        last[:-1] = visit_flight[:-1] != visit_flight[1:]
+        middle = ~(first | last)
+        return np.bincount(table.visit_airport[middle],
+                           weights=table.passengers[visit_flight[middle]],
+                           minlength=self.n_airports)
+
+    def pagerank(self, damping=0.85, tol=1e-10, max_iter=200):
+        """Passenger-weighted PageRank, by power iteration with sparse
+        matrix-vector products done through np.bincount()."""
+        n = self.n_airports
+        out_weight = np.bincount(self.src, weights=self.passengers, minlength=n)
+        edge_share = self.passengers / np.where(out_weight > 0, out_weight, 1)[self.src]
+        dangling = out_weight == 0
+        rank = np.full(n, 1.0 / n)
+        for _ in range(max_iter):
+            flow = np.bincount(self.dst, weights=rank[self.src] * edge_share, minlength=n)
+            new_rank = (1 - damping) / n + damping * (flow + rank[dangling].sum() / n)
+            converged = np.abs(new_rank - rank).sum() < tol
+            rank = new_rank
+            if converged:
+                break
+        return rank
+
+    def connected_components(self):
+        """Labels each airport with the smallest index in its (weakly)
+        connected component, by label propagation with pointer jumping.
+        Airports with no legs are components of their own."""
+        labels = np.arange(self.n_airports)
+        while True:
+            new_labels = labels.copy()
+            np.minimum.at(new_labels, self.src, labels[self.dst])
+            np.minimum.at(new_labels, self.dst, labels[self.src])
+            new_labels = new_labels[new_labels]
+            if np.array_equal(new_labels, labels):
+                return labels
+            labels = new_labels
+
+
+def hub_report(network, fname='hub_report.txt'):
+    """Ranks the airports by hub score and writes the report; returns
+    the list of rows."""
+    degree = network.degree()
+    throughput = network.throughput()
+    transit = network.transit_passengers()
+    rank = network.pagerank()
+    components = network.connected_components()
+    # number the components by decreasing size
+    labels, sizes = np.unique(components, return_counts=True)
+    component_no = {label: i + 1 for i, label in
+                    enumerate(labels[np.argsort(-sizes, kind='stable')])}
+    served = degree > 0
+    print(f'# {np.count_nonzero(served)} airports served, {len(network.src)} distinct legs,'
+          f' {len(set(components[served].tolist()))} connected components')
+    rows = []
+    for i in np.argsort(-rank, kind='stable'):
+        if not served[i]:
+            continue
+        rows.append((network.airport_codes[i], rank[i], int(degree[i]), throughput[i],
+                     transit[i], component_no[components[i]]))
+    with open(fname, 'w') as fp:
+        fp.write(f"{'rank':>5} {'airport':>7} {'hub_score':>10} {'degree':>7}"
+                 f" {'throughput':>11} {'transit':>9} {'component':>9}\n")
+        for n, (code, score, deg, thru, trans, comp) in enumerate(rows, 1):
+            fp.write(f'{n:>5} {code:>7} {score:10.5f} {deg:>7} {thru:11.0f}'
+                     f' {trans:9.0f} {comp:>9}\n')
+    print('# wrote hub report to file', fname)
+    return rows
+
+
+def main():
+    flights_fname = 'profitable_flights.txt'
+    if len(sys.argv) > 2:
+        raise Exception(f'*error* too many arguments - usage: {sys.argv[0]} [flight_fname]')
+    elif len(sys.argv) == 2:
+        flights_fname = sys.argv[1]
+    network = RouteNetwork(FlightTable(iter_flights_newstyle(flights_fname)))
+    rows = hub_report(network)
+    for code, score, deg, thru, trans, comp in rows[:10]:
+        print(f'{code}: hub score {score:.4f}, degree {deg}, throughput {thru:.0f},'
+              f' transit {trans:.0f}')
+
+
+if __name__ == '__main__':
+    main()
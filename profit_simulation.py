@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+"""Monte Carlo simulation of the profit of every flight.
+
+The passengers in a flight file are one draw of a random quantity, and
+so is the operating cost (fuel prices, winds...), so a single profit
+number can make a risky route look safe.  Here we draw many
+replications for every route at once: passengers are Poisson around
+the recorded count (capped by the seats on the aircraft) and the
+operating cost gets a log-normal factor with mean 1.  From the draws
+we get the expected profit, its variance, and the probability of
+falling below the profit threshold of prune_unprofitable_flights().
+
+Every block of seed_block routes takes its draws from its own
+generator, spawned from the seed, so with a seed the results are the
+same however the routes are chunked.  The routes are simulated a few
+blocks at a time, so that no more than max_elements draws are held in
+memory at a time -- fewer if that would not fit in the memory budget
+(see memory_profile.py).
+"""
+
+import argparse
+import numpy as np
+
+from flight_utils import *
+from cost_model import CostModel, FlightTable
+from flight_optimization import profit_threshold
+from memory_profile import memory_budget, exit_on_budget_exceeded
+
+cost_sigma = 0.1                # spread of the operating cost factor
+max_elements = 4000000          # draws held in memory at once
+bytes_per_draw = 48             # arrays of draws alive at once, 8 bytes each
+seed_block = 16                 # routes drawn from one generator
+
+
+def simulate_profits(table, model=None, n_draws=10000, seed=None,
+                     threshold=profit_threshold):
+    """Simulates n_draws profits for every flight in the FlightTable.
+    Returns three arrays: expected profit, profit variance, and the
+    probability that the profit is below threshold."""
+    if model is None:
+        model = CostModel()
+    seats = aircraft_types[model.aircraft]['seats']
+    operational_cost = (aircraft_types[model.aircraft]['cost_per_hour']
+                        * model.flight_time(table))
+    fixed_cost = model.cost(table) - operational_cost
+    mean_passengers = np.minimum(table.passengers, seats)
+    fares = model.fares(table)
+
+    expected = np.empty(table.n_flights)
+    variance = np.empty(table.n_flights)
+    prob_below = np.empty(table.n_flights)
+    # the budget only sets how many blocks are drawn at once, never
+    # which draws a route gets
+    elements = max_elements
+    available = memory_budget.available()
+    if available is not None:
+        memory_budget.require(seed_block * n_draws * bytes_per_draw,
+                              f'simulating {n_draws} draws of {seed_block} flights',
+                              advice='use fewer draws')
+        elements = min(elements, available // bytes_per_draw)
+    blocks_per_chunk = max(1, elements // (seed_block * n_draws))
+    rows_per_chunk = blocks_per_chunk * seed_block
+    n_blocks = -(-table.n_flights // seed_block)
+    block_seeds = np.random.SeedSequence(seed).spawn(n_blocks)
+    for start in range(0, table.n_flights, rows_per_chunk):
+        rows = slice(start, min(start + rows_per_chunk, table.n_flights))
+        n_rows = rows.stop - rows.start
+        passengers = np.empty((n_rows, n_draws), dtype=np.int64)
+        cost_factor = np.empty((n_rows, n_draws))
+        for block_start in range(rows.start, rows.stop, seed_block):
+            block = slice(block_start, min(block_start + seed_block, rows.stop))
+            chunk_rows = slice(block.start - start, block.stop - start)
+            rng = np.random.default_rng(block_seeds[block_start // seed_block])
+            passengers[chunk_rows] = rng.poisson(mean_passengers[block, None],
+                                                 size=(block.stop - block.start, n_draws))
+            cost_factor[chunk_rows] = rng.lognormal(-cost_sigma**2 / 2, cost_sigma,
+                                                    size=(block.stop - block.start, n_draws))
+        passengers = np.minimum(passengers, seats)
+        profit = (fares[rows, None] * passengers
+                  - operational_cost[rows, None] * cost_factor
+                  - fixed_cost[rows, None])
+        expected[rows] = profit.mean(axis=1)
+        variance[rows] = profit.var(axis=1, ddof=1) if n_draws > 1 else 0.0
+        prob_below[rows] = (profit < threshold).mean(axis=1)
+    return expected, variance, prob_below
+
+
+def risk_adjusted_profits(flights, risk_aversion, n_draws=10000, seed=None,
+                          model=None):
+    """Returns a dictionary from flight_number to expected profit minus
+    risk_aversion standard deviations, for prune_unprofitable_flights()."""
+    table = FlightTable(flights)
+    expected, variance, _ = simulate_profits(table, model, n_draws, seed)
+    adjusted = expected - risk_aversion * np.sqrt(variance)
+    return dict(zip(table.flight_numbers, adjusted.tolist()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monte Carlo simulation of the profit of every flight.')
+    parser.add_argument('flights_fname', nargs='?', default='sorted_flights_new.txt',
+                        help='newstyle flight file to simulate')
+    parser.add_argument('--draws', type=int, default=10000,
+                        help='replications per flight')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed')
+    parser.add_argument('--out', default='profit_risk.txt',
+                        help='file in which to write the results')
+    args = parser.parse_args()
+
+    flights = load_flights_newstyle(args.flights_fname)
+    table = FlightTable(flights)
+    with exit_on_budget_exceeded():
+        expected, variance, prob_below = simulate_profits(table, n_draws=args.draws,
+                                                          seed=args.seed)
+    with FlightFileWriter(args.out) as writer:
+        for i, record in enumerate(flights):
+            writer.write({'flight_number': record['flight_number'],
+                          'flight_path': record['flight_path'],
+                          'expected_profit': f'{expected[i]:.2f}',
+                          'profit_std': f'{np.sqrt(variance[i]):.2f}',
+                          'prob_below_threshold': f'{prob_below[i]:.4f}'})
+    print(f'# simulated {args.draws} draws for {table.n_flights} flights')
+    print(f'# expected total profit: ${expected.sum():.2f}')
+    print(f'# flights more likely than not below ${profit_threshold}:'
+          f' {np.count_nonzero(prob_below > 0.5)}')
+    print('# wrote profit simulation to file', args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+
+"""Runs the sort and prune stages on flight files larger than memory.
+
+The flight file is partitioned by origin airport into shard files on
+disk.  Each shard is small enough to reorder (reorder_stops_new()) and
+prune (prune_unprofitable_flights()) on its own.  The replacement step
+needs every profitable flight at once, but only their airports: we
+keep those as a compact array of airport indices, and stream the
+eliminated flights past it in blocks, finding each one's closest match
+with the same metric as calc_cumulative_distance_metric().  Finally
+the shards are merged back into single files in the original order,
+with the passengers of the eliminated flights accommodated as in
+accommodate_passengers().
+
+Every record carries its position in the input file (as shard_order)
+while it is in a shard, so the merge can restore the order, ties in
+the replacement search go to the same flight as in
+find_closest_match(), and the accommodation is applied in the same
+order as in flight_optimization.py.
+"""
+
+import argparse
+import heapq
+import os
+import shutil
+import tempfile
+import zlib
+import numpy as np
+
+from flight_utils import *
+from flight_optimization import prune_unprofitable_flights
+from sort_flights_by_distance import reorder_stops_new
+
+block_size = 10000              # eliminated flights read at a time
+candidate_chunk = 100000        # candidates compared at a time
+
+
+def shard_of(origin, n_shards):
+    # crc32 rather than hash(), which changes from run to run
+    return zlib.crc32(origin.encode()) % n_shards
+
+
+def partition_by_origin(fname, shard_dir, n_shards):
+    """Splits the flight file into n_shards files by origin airport;
+    returns their names."""
+    shard_fnames = [os.path.join(shard_dir, f'shard_{i}.txt') for i in range(n_shards)]
+    writers = [FlightFileWriter(shard_fname, buffer_records=1000)
+               for shard_fname in shard_fnames]
+    for order_no, record in enumerate(iter_flights_newstyle(fname)):
+        record['shard_order'] = order_no
+        writers[shard_of(record['origin'], n_shards)].write(record)
+    for writer in writers:
+        writer.close()
+    return shard_fnames
+
+
+def process_shard(shard_fname, memo=None):
+    """Reorders and prunes one shard; writes the sorted, profitable and
+    eliminated flights next to it and returns their file names."""
+    base = shard_fname[:-len('.txt')]
+    flights = reorder_stops_new(load_flights_newstyle(shard_fname), memo)
+    profitable, eliminated = prune_unprofitable_flights(flights)
+    out_fnames = (base + '_sorted.txt', base + '_profitable.txt', base + '_eliminated.txt')
+    for out_fname, records in zip(out_fnames, [flights, profitable, eliminated]):
+        with FlightFileWriter(out_fname) as writer:
+            for record in records:
+                writer.write(record)
+    return out_fnames
+
+
+class CandidateSet:
+    """The airports of every profitable flight, as a padded matrix of
+    airport indices, ordered by their position in the input file."""
+
+    def __init__(self, profitable_fnames, code2index):
+        orders = []
+        flight_paths = []
+        passengers = []
+        city_lists = []
+        for fname in profitable_fnames:
+            for record in iter_flights_newstyle(fname):
+                orders.append(int(record['shard_order']))
+                flight_paths.append(record['flight_path'])
+                passengers.append(int(record['passengers']))
+                city_lists.append([code2index[c] for c in flight_path2city_list(record['flight_path'])])
+        order = np.argsort(orders, kind='stable')
+        self.flight_paths = [flight_paths[i] for i in order]
+        self.passengers = np.array(passengers, dtype=np.int64)[order]
+        max_len = max((len(c) for c in city_lists), default=1)
+        self.cities = np.zeros((len(city_lists), max_len), dtype=np.int32)
+        self.mask = np.zeros((len(city_lists), max_len), dtype=bool)
+        for row, i in enumerate(order):
+            self.cities[row, :len(city_lists[i])] = city_lists[i]
+            self.mask[row, :len(city_lists[i])] = True
+
+    def closest_match(self, elim_cities, distance_matrix):
+        """Index of the candidate with the smallest cumulative distance
+        to the eliminated cities (the first one, on ties)."""
+        best_metric = np.inf
+        best = None
+        for start in range(0, len(self.cities), candidate_chunk):
+            cities = self.cities[start:start + candidate_chunk]
+            mask = self.mask[start:start + candidate_chunk]
+            distances = np.where(mask, distance_matrix[elim_cities][:, cities], np.inf)
+            metric = distances.min(axis=2).sum(axis=0)
+            i = int(np.argmin(metric))
+            if metric[i] < best_metric:
+                best_metric = metric[i]
+                best = start + i
+        return best
+
+
+def find_replacements_streaming(eliminated_fnames, candidates, code2index, distance_matrix):
+    """Streams the eliminated flights in blocks and returns the new
+    passenger count of every replacement flight path, as
+    accommodate_passengers() would set it."""
+    # flight_path -> (shard_order of the eliminated flight, passengers);
+    # as in accommodate_passengers(), the last eliminated flight wins
+    updated = {}
+    block = []
+    if len(candidates.cities) == 0:
+        # nothing left to replace the eliminated flights with
+        return {}
+
+    def do_block():
+        for record in block:
+            elim_cities = [code2index[c] for c in flight_path2city_list(record['flight_path'])]
+            best = candidates.closest_match(elim_cities, distance_matrix)
+            path = candidates.flight_paths[best]
+            accommodated = min(int(record['passengers']) + int(candidates.passengers[best]),
+                               seat_capacity)
+            order = int(record['shard_order'])
+            if path not in updated or updated[path][0] < order:
+                updated[path] = (order, accommodated)
+        block.clear()
+
+    for fname in eliminated_fnames:
+        for record in iter_flights_newstyle(fname):
+            block.append(record)
+            if len(block) >= block_size:
+                do_block()
+    do_block()
+    return {path: passengers for path, (_, passengers) in updated.items()}
+
+
+def merge_shards(shard_fnames, out_fname, updated_passengers=None):
+    """Merges the shard files (each in input order) into one file in
+    input order, dropping the shard_order field."""
+    def ordered(fname):
+        for record in iter_flights_newstyle(fname):
+            yield int(record['shard_order']), record
+    with FlightFileWriter(out_fname) as writer:
+        for _, record in heapq.merge(*[ordered(f) for f in shard_fnames],
+                                     key=lambda pair: pair[0]):
+            del record['shard_order']
+            if updated_passengers and record['flight_path'] in updated_passengers:
+                record['passengers'] = updated_passengers[record['flight_path']]
+            writer.write(record)
+    print('# wrote newstyle routes to file', out_fname)
+
+
+def run_sharded(fname, n_shards=16, shard_dir=None,
+                sorted_fname='sorted_flights_new.txt',
+                profitable_fname='profitable_flights.txt'):
+    """The whole sharded sort + prune + replace run."""
+    keep_shards = shard_dir is not None
+    if shard_dir is None:
+        shard_dir = tempfile.mkdtemp(prefix='flight_shards_', dir='.')
+    else:
+        os.makedirs(shard_dir, exist_ok=True)
+    try:
+        shard_fnames = partition_by_origin(fname, shard_dir, n_shards)
+        memo = StopOrderMemo()
+        outputs = [process_shard(shard_fname, memo) for shard_fname in shard_fnames]
+        sorted_fnames, profitable_fnames, eliminated_fnames = zip(*outputs)
+        memo.report()
+        codes = list(airports.keys())
+        code2index = {code: i for i, code in enumerate(codes)}
+        distance_matrix = haversine_distance_matrix_nm([airports[c]['lat'] for c in codes],
+                                                       [airports[c]['lon'] for c in codes])
+        candidates = CandidateSet(profitable_fnames, code2index)
+        updated_passengers = find_replacements_streaming(eliminated_fnames, candidates,
+                                                         code2index, distance_matrix)
+        merge_shards(sorted_fnames, sorted_fname)
+        merge_shards(profitable_fnames, profitable_fname, updated_passengers)
+    finally:
+        if not keep_shards:
+            shutil.rmtree(shard_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sort, prune and replace flights shard by shard.')
+    parser.add_argument('flights_fname', nargs='?', default='generated_flights_new.txt',
+                        help='newstyle flight file to process')
+    parser.add_argument('--shards', type=int, default=16, help='number of shards')
+    parser.add_argument('--shard-dir', default=None,
+                        help='keep the shard files in this directory (default: a temporary one)')
+    args = parser.parse_args()
+    run_sharded(args.flights_fname, args.shards, args.shard_dir)
+
+
+if __name__ == '__main__':
+    main()
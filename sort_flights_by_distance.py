@@ -5,82 +5,108 @@ writes out a file sorted by total miles flown.  The shortest of those
 paths is written out first.
 """
 
-import sys
+import argparse
 import pprint
-import re
+import itertools
 from math import radians, sin, cos, sqrt, atan2
 
 from flight_utils import *
-
-def parse_flight_data(lines):
-    flight_data = {}
+from stage_cache import StageCache, stage_key, code_version
+from memory_profile import memory_budget, flight_file_memory, add_memory_arguments, setup_memory
+
+def parse_coordinates(value):
+    lat, lon = value.split(",")
+    return (float(lat), float(lon))
+
+def parse_airport(value):
+    return value.split()[0]
+
+def parse_dollars(value):
+    return float(value.lstrip("$"))
+
+# how to parse each "Key: value" line of an oldstyle record: the key
+# maps to the field it sets and the function that converts the value.
+# Lines with other keys (distance, profit...) are recomputed, not read.
+legacy_fields = {
+    "Flight Path": ('flight_path', str),
+    "Origin": ('origin', parse_airport),
+    "Origin Coordinates": ('origin_coordinates', parse_coordinates),
+    "Destination": ('destination', parse_airport),
+    "Destination Coordinates": ('destination_coordinates', parse_coordinates),
+    "Stops": ('stops', int),
+    "Stop1": ('stop1', parse_airport),
+    "Stop1 Coordinates": ('stop1_coordinates', parse_coordinates),
+    "Stop2": ('stop2', parse_airport),
+    "Stop2 Coordinates": ('stop2_coordinates', parse_coordinates),
+    "Passengers": ('passengers', int),
+    "Layover Time (Hours)": ('layover_time', float),
+    "Maintenance Cost": ('maintenance_cost', parse_dollars),
+    "Income of Flight": ('flight_income', parse_dollars),
+}
+
+def iter_flight_data(lines, keep_lines=False):
+    """Parses oldstyle records in a single pass over lines (any
+    iterable, such as an open file), yielding (flight_number, data)
+    pairs.  Each line is dispatched on its key with one lookup in
+    legacy_fields.  The raw lines of a record are only kept (as
+    data['lines']) if keep_lines is True."""
     flight_number = None
-    current_lines = []
-
+    data = None
     for line in lines:
-        if line.startswith("Flight:"):
+        key, sep, value = line.partition(":")
+        if not sep:
+            if keep_lines and data is not None:
+                data['lines'].append(line)
+            continue
+        if key == "Flight":
             if flight_number is not None:
-                flight_data[flight_number]['lines'] = current_lines
-            flight_number = int(line.split(":")[1].strip())
-            flight_data[flight_number] = {}
-            current_lines = [line]
-        elif line.startswith("Flight Path:"):
-            flight_data[flight_number]['flight_path'] = line.split(":")[1].strip()
-            current_lines.append(line)
-        elif line.startswith("Origin:"):
-            flight_data[flight_number]['origin'] = line.split(":")[1].strip().split()[0]
-            current_lines.append(line)
-        elif line.startswith("Origin Coordinates:"):
-            coords = line.split(":")[1].strip().split(",")
-            flight_data[flight_number]['origin_coordinates'] = (float(coords[0]), float(coords[1]))
-            current_lines.append(line)
-        elif line.startswith("Destination:"):
-            flight_data[flight_number]['destination'] = line.split(":")[1].strip().split()[0]
-            current_lines.append(line)
-        elif line.startswith("Destination Coordinates:"):
-            coords = line.split(":")[1].strip().split(",")
-            flight_data[flight_number]['destination_coordinates'] = (float(coords[0]), float(coords[1]))
-            current_lines.append(line)
-        elif line.startswith("Stops:"):
-            flight_data[flight_number]['stops'] = int(line.split(":")[1].strip())
-            current_lines.append(line)
-        elif line.startswith("Stop1:"):
-            stop1 = line.split(":")[1].strip().split()[0]
-            if stop1 != "None":
-                flight_data[flight_number]['stop1'] = stop1
-            current_lines.append(line)
-        elif line.startswith("Stop1 Coordinates:"):
-            coords = line.split(":")[1].strip().split(",")
-            flight_data[flight_number]['stop1_coordinates'] = (float(coords[0]), float(coords[1]))
-            current_lines.append(line)
-        elif line.startswith("Stop2:"):
-            stop2 = line.split(":")[1].strip().split()[0]
-            if stop2 != "None":
-                flight_data[flight_number]['stop2'] = stop2
-            current_lines.append(line)
-        elif line.startswith("Stop2 Coordinates:"):
-            coords = line.split(":")[1].strip().split(",")
-            flight_data[flight_number]['stop2_coordinates'] = (float(coords[0]), float(coords[1]))
-            current_lines.append(line)
-        elif line.startswith("Passengers:"):
-            flight_data[flight_number]['passengers'] = int(line.split(":")[1].strip())
-            current_lines.append(line)
-        elif line.startswith("Layover Time (Hours):"):
-            flight_data[flight_number]['layover_time'] = float(line.split(":")[1].strip())
-            current_lines.append(line)
-        elif line.startswith("Maintenance Cost:"):
-            flight_data[flight_number]['maintenance_cost'] = float(line.split(": $")[1].strip())
-            current_lines.append(line)
-        elif line.startswith("Income of Flight:"): 
-            flight_data[flight_number]['flight_income'] = float(line.split(": $")[1].strip())
-            current_lines.append(line)
-        else:
-            current_lines.append(line)
-
+                yield flight_number, data
+            flight_number = int(value.strip())
+            data = {'lines': [line]} if keep_lines else {}
+            continue
+        if data is None:
+            continue
+        if keep_lines:
+            data['lines'].append(line)
+        field = legacy_fields.get(key)
+        if field is None:
+            continue
+        name, convert = field
+        value = convert(value.strip())
+        if name in ('stop1', 'stop2') and value == "None":
+            continue
+        data[name] = value
     if flight_number is not None:
-        flight_data[flight_number]['lines'] = current_lines
-
-    return flight_data
+        yield flight_number, data
+
+def parse_flight_data(lines, keep_lines=False):
+    return dict(iter_flight_data(lines, keep_lines))
+
+def legacy2newstyle(flight_number, data):
+    """The newstyle record of a parsed oldstyle flight."""
+    return {'flight_number': flight_number,
+            'origin': data['origin'],
+            'destination': data['destination'],
+            'passengers': data['passengers'],
+            'flight_path': data['flight_path'],
+            'n_stops': data['stops']}
+
+def iter_flights_any_style(fname):
+    """Newstyle records from a flight file of either format ('-' for
+    stdin).  The format is told from the first key, which is read
+    ahead and put back, so the file is only read once."""
+    with open_flight_file(fname, 'r') as fp:
+        first_lines = []
+        for line in fp:
+            first_lines.append(line)
+            if line.strip():
+                break
+        lines = itertools.chain(first_lines, fp)
+        if first_lines and first_lines[-1].startswith("Flight:"):
+            for flight_number, data in iter_flight_data(lines):
+                yield legacy2newstyle(flight_number, data)
+        else:
+            yield from iter_records_newstyle(lines)
 
 def haversine_distance(coord1, coord2):
     """Calculate the great-circle distance between two points on the Earth's surface."""
@@ -172,9 +198,9 @@ def calculate_flight_time(lon1, lat1, lon2, lat2):
     if None in [lat1, lon1, lat2, lon2]:
         return 0, 0, 0  # Handle invalid coordinates
     distance_nm = haversine_distance((lat1, lon1), (lat2, lon2))
-    speed_knots = 485  # Average speed of a Boeing 737 MAX in knots
-    flight_time = distance_nm / speed_knots
-    operational_cost = 5757 * flight_time
+    aircraft = aircraft_types[default_aircraft]
+    flight_time = distance_nm / aircraft['speed_knots']
+    operational_cost = aircraft['cost_per_hour'] * flight_time
     return flight_time, operational_cost, distance_nm
 
 def simulate_layover(stops, flight_time, operational_cost):
@@ -183,9 +209,8 @@ def simulate_layover(stops, flight_time, operational_cost):
     maintenance_cost = 0
     
     if stops > 0:
-        layover_time = 1.5 * stops  # Layover time in hours
-        maintenance_cost_per_hour = 150  # Maintenance cost per hour
-        maintenance_cost = (layover_time * maintenance_cost_per_hour) + operational_cost
+        layover_time = layover_time_per_stop * stops  # Layover time in hours
+        maintenance_cost = (layover_time * layover_cost_per_hour) + operational_cost
     else:
         maintenance_cost = operational_cost
 
@@ -334,46 +359,110 @@ def write_sorted_flights(flight_data):
             file.write("\n")
 
 def main():
-    file_name = 'flights.txt'  
-    file_name_newstyle = 'generated_flights_new.txt'
-    if len(sys.argv) > 2:
-        raise Exception('Too many arguments')
-    elif len(sys.argv) == 2:
-        file_name_newstyle = sys.argv[1]
-
-    # oldstyle approach
-    with open('flights.txt', 'r') as file:
-        lines = file.readlines()
+    parser = argparse.ArgumentParser(description='Reorder the stops of every flight to minimize distance.')
+    parser.add_argument('file_name_newstyle', nargs='?', default='generated_flights_new.txt',
+                        help='flight file to reorder (newstyle, or oldstyle like flights.txt);'
+                             ' - reads it from stdin')
+    parser.add_argument('--out', default=None,
+                        help='file in which to write the sorted flights; - writes them to stdout'
+                             ' as they are reordered (the default when reading stdin)')
+    parser.add_argument('--legacy', nargs='?', const='flights.txt', default=None,
+                        help='also run the oldstyle reordering on this file (default flights.txt)')
+    parser.add_argument('--memo', default=None,
+                        help='pickle file in which the stop order memo is kept between runs')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always redo the sort, even if the stage cache has the result')
+    add_memory_arguments(parser)
+    args = parser.parse_args()
+    file_name_newstyle = args.file_name_newstyle
+    profiler = setup_memory(args, 'sort_flights_by_distance')
+
+    if args.out is not None:
+        fname_out = args.out
+    elif file_name_newstyle == '-':
+        fname_out = '-'
+    elif file_name_newstyle == 'profitable_flights.txt':
+        fname_out = 'sorted_profitable_flights.txt'
+    else:
+        fname_out = 'sorted_flights_new.txt'
 
-    flight_data = parse_flight_data(lines)
-    reorder_stops(flight_data)
-    write_sorted_flights(flight_data)
+    # oldstyle approach, only when asked for
+    if args.legacy is not None:
+        with diagnostics_to_stderr(fname_out), profiler.step(f'oldstyle {args.legacy}'):
+            with open_flight_file(args.legacy, 'r') as file:
+                flight_data = parse_flight_data(file)
+            reorder_stops(flight_data)
+            write_sorted_flights(flight_data)
 
     # then do the newstyle approach
-    all_flights_new = load_flights_newstyle(file_name_newstyle)
-    print('============ what I just loaded ================')
-    pprint.pprint(all_flights_new)
-    print('================== (DONE) ======================')
-    ordered_flights = reorder_stops_new(all_flights_new)
-    if file_name_newstyle == 'profitable_flights.txt':
-        write_flights_newstyle('sorted_profitable_flights.txt', ordered_flights)
+    if '-' in (file_name_newstyle, fname_out):
+        # a pipeline stage: every flight is reordered on its own, so
+        # each one is written out as soon as it is read, and the next
+        # stage starts on it while this one reads on.  There is no file
+        # to cache and no need to hold the flights in memory.
+        memo = StopOrderMemo(args.memo)
+        with diagnostics_to_stderr(fname_out):
+            with profiler.step('reorder (streaming)'):
+                write_flights_newstyle(fname_out, iter_reorder_stops_new(
+                    iter_flights_any_style(file_name_newstyle), memo))
+            finish_sort(args, memo, profiler)
+        return
+    # same input file and same code means the same sorted output
+    cache = StageCache()
+    key = stage_key('sort_flights_by_distance', [file_name_newstyle], {},
+                    code_version('sort_flights_by_distance', 'flight_utils'))
+    if not args.no_cache and cache.lookup(key, [fname_out]):
+        print(f'# {file_name_newstyle} unchanged, restored {fname_out} from the stage cache')
+        return
+    memo = StopOrderMemo(args.memo)
+    if memory_budget.fits(flight_file_memory(file_name_newstyle)):
+        with profiler.step('load'):
+            all_flights_new = list(iter_flights_any_style(file_name_newstyle))
+        print('============ what I just loaded ================')
+        pprint.pprint(all_flights_new)
+        print('================== (DONE) ======================')
+        with profiler.step('reorder'):
+            ordered_flights = reorder_stops_new(all_flights_new, memo)
+        with profiler.step('write'):
+            write_flights_newstyle(fname_out, ordered_flights)
     else:
-        write_flights_newstyle('sorted_flights_new.txt', ordered_flights)
-
-def reorder_stops_new(all_flights):
+        # the flights would not fit in memory: every flight is reordered
+        # on its own anyway, so stream them through one at a time
+        print(f'# {file_name_newstyle} is too big for the memory budget, reordering it as a stream')
+        with profiler.step('reorder (streaming)'):
+            write_flights_newstyle(fname_out, iter_reorder_stops_new(
+                iter_flights_any_style(file_name_newstyle), memo))
+    cache.store(key, [fname_out])
+    finish_sort(args, memo, profiler)
+
+def finish_sort(args, memo, profiler):
+    if args.memo is not None:
+        memo.save()
+    memo.report()
+    profiler.report()
+
+def reorder_stops_new(all_flights, memo=None):
     """Takes a list of all the flight routes and reorders *each* flight
-    path by its total distance traveled."""
-    reordered_flight_list = []
+    path by its total distance traveled.  Orderings are looked up in
+    (and added to) memo, which defaults to one shared by all calls."""
+    return list(iter_reorder_stops_new(all_flights, memo))
+
+def iter_reorder_stops_new(all_flights, memo=None):
+    """Generator version of reorder_stops_new(), for any iterable of
+    flights."""
+    if memo is None:
+        memo = default_stop_order_memo
     for record in all_flights:
         orig_city_order = flight_path2city_list(record['flight_path'])
         orig_distance = calc_distance_new(orig_city_order)
-        new_city_order = rearrange_cities_for_shortest_path(orig_city_order)
-        new_distance = calc_distance_new(new_city_order)
+        new_city_order, new_distance = memo.shortest_path(orig_city_order)
         print('REORDER:', record['flight_number'], orig_distance, new_city_order, new_distance)
         new_record = record
         new_record['flight_path'] = ', '.join(new_city_order)
-        reordered_flight_list.append(new_record)
-    return reordered_flight_list
+        yield new_record
+
+# shared by all reorder_stops_new() calls that don't pass their own memo
+default_stop_order_memo = StopOrderMemo()
 
         
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+"""Content-addressed cache of pipeline stage outputs.
+
+A stage (sorting the flights, pruning them...) is a function of its
+input files, its parameters and its code.  We hash all three into a
+key, and keep the output files of each run in a directory named after
+the key.  When a script is run again with the same inputs, parameters
+and code, it copies the cached outputs into place instead of redoing
+the work.
+
+The cache directory is kept under a size limit by evicting the least
+recently used entries.
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+
+default_cache_dir = '.stage_cache'
+default_max_bytes = 1 << 30     # 1 GiB
+
+
+def file_digest(fname, chunk_size=1024 * 1024):
+    """sha256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def code_version(*module_names):
+    """Digest of the source files of the given modules, so that
+    changing the code invalidates the cache."""
+    digest = hashlib.sha256()
+    for name in module_names:
+        digest.update(name.encode())
+        digest.update(file_digest(importlib.util.find_spec(name).origin).encode())
+    return digest.hexdigest()
+
+
+def stage_key(stage_name, input_fnames, params, code):
+    """The cache key of one run of a stage."""
+    digest = hashlib.sha256()
+    digest.update(stage_name.encode())
+    for fname in input_fnames:
+        digest.update(file_digest(fname).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    digest.update(code.encode())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """A directory with one subdirectory of output files per key."""
+
+    def __init__(self, cache_dir=default_cache_dir, max_bytes=default_max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key, output_fnames):
+        """If the key is cached, copies its outputs to output_fnames and
+        returns True; otherwise returns False."""
+        entry = self.entry_dir(key)
+        cached = [os.path.join(entry, os.path.basename(fname)) for fname in output_fnames]
+        if not all(os.path.exists(path) for path in cached):
+            return False
+        for path, fname in zip(cached, output_fnames):
+            tmp_fname = f'{fname}.{os.getpid()}.tmp'
+            try:
+                shutil.copyfile(path, tmp_fname)
+            except FileNotFoundError:
+                # evicted by another run since we looked
+                return False
+            os.replace(tmp_fname, fname)
+        # mark as recently used (unless it was evicted meanwhile; we
+        # have its outputs anyway)
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def store(self, key, output_fnames):
+        """Saves copies of the output files under the key, then evicts
+        old entries if the cache is too big."""
+        entry = self.entry_dir(key)
+        tmp_entry = f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(tmp_entry, exist_ok=True)
+        for fname in output_fnames:
+            shutil.copyfile(fname, os.path.join(tmp_entry, os.path.basename(fname)))
+        # the key is a hash of everything the outputs depend on, so an
+        # entry already there (say from a concurrent run with the same
+        # key, which may be moving it into place right now) has the same
+        # outputs: keep it and throw ours away
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits
+        in max_bytes."""
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                mtime = os.path.getmtime(entry)
+            except FileNotFoundError:
+                # evicted by another run meanwhile
+                continue
+            entries.append((mtime, size, entry))
+            total_bytes += size
+        for _, size, entry in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_bytes -= size